@@ -0,0 +1,88 @@
+import os
+import time
+import atexit
+import threading
+import tensorflow as tf
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class AsyncSaver(object):
+    """Writes checkpoints of `var_list` on a background thread.
+
+    `save` only fetches the variable values from the training session into
+    host memory and returns. A writer thread assigns the values into a
+    private graph and saves it with a regular `tf.train.Saver` keyed by the
+    original variable names, so the checkpoints restore with the usual
+    `Saver` of the training graph. At most one snapshot waits behind the
+    one being written, and `close` (registered with atexit) writes whatever
+    is still queued.
+    """
+    def __init__(self, var_list, max_to_keep=5):
+        self.var_list = list(var_list)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = []
+            assign_ops = []
+            shadow_vars = {}
+            for i, v in enumerate(self.var_list):
+                dtype = v.dtype.base_dtype
+                shadow = tf.get_variable('v{}'.format(i), v.shape, dtype, initializer=tf.zeros_initializer(), trainable=False)
+                placeholder = tf.placeholder(dtype, v.shape)
+                self.placeholders.append(placeholder)
+                assign_ops.append(tf.assign(shadow, placeholder))
+                shadow_vars[v.op.name] = shadow
+            self.assign_op = tf.group(*assign_ops)
+            self.saver = tf.train.Saver(shadow_vars, max_to_keep=max_to_keep)
+            self.sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+            self.sess.run(tf.global_variables_initializer())
+        self.recovered = False
+        # (snapshot seconds, write seconds) of every finished save
+        self.latencies = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, sess, save_path, global_step=None):
+        if self.error is not None:
+            raise self.error
+        start = time.time()
+        values = sess.run(self.var_list)
+        self.queue.put((values, save_path, global_step, time.time() - start))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            values, save_path, global_step, snapshot_time = job
+            start = time.time()
+            try:
+                self._write(values, save_path, global_step)
+                self.latencies.append((snapshot_time, time.time() - start))
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _write(self, values, save_path, global_step):
+        if not self.recovered:
+            # let max_to_keep also rotate the checkpoints of a previous run
+            ckpt = tf.train.get_checkpoint_state(os.path.dirname(save_path))
+            if ckpt is not None:
+                self.saver.recover_last_checkpoints(list(ckpt.all_model_checkpoint_paths))
+            self.recovered = True
+        self.sess.run(self.assign_op, feed_dict=dict(zip(self.placeholders, values)))
+        self.saver.save(self.sess, save_path, global_step=global_step, write_meta_graph=False)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
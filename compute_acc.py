@@ -1,7 +1,10 @@
+import os
+import json
+import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.slim.nets import inception
 slim = tf.contrib.slim
-from mytools import load_path_label
+from mytools import load_path_label, DecodePool
 from tqdm import tqdm
 
 tf.flags.DEFINE_string(
@@ -22,12 +25,53 @@ tf.flags.DEFINE_integer(
     'batch_size', 16, 'Batch size to processing images')
 tf.flags.DEFINE_integer(
     'num_classes', 110, 'How many classes of the data set')
+tf.flags.DEFINE_integer(
+    'num_loader_workers', 0, 'Processes used to decode images, 0 to decode in the main process')
+tf.flags.DEFINE_integer(
+    'loader_prefetch', 2, 'How many batches the loader workers decode ahead')
 FLAGS = tf.flags.FLAGS
 
 def gaussian_noise_layer(input_layer, std):
     noise = tf.random_normal(shape=tf.shape(input_layer), mean=0.0, stddev=std, dtype=tf.float32) 
     return input_layer + noise
 
+class ConfusionMatrix(object):
+    """Confusion matrix with top-5 hits, updated with one bincount per batch.
+
+    Rows are true labels and columns are top-1 predictions.
+    """
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.matrix = np.zeros([num_classes, num_classes], dtype=np.int64)
+        self.top5_hits = 0
+
+    def update(self, true_labels, top_labels):
+        # the loader pads the last batch, only the first len(true_labels) rows are real
+        true_labels = np.asarray(true_labels, dtype=np.int64)
+        top_labels = np.asarray(top_labels, dtype=np.int64)[:len(true_labels)]
+        self.matrix += np.bincount(true_labels * self.num_classes + top_labels[:, 0],
+                                   minlength=self.num_classes ** 2).reshape(self.num_classes, self.num_classes)
+        self.top5_hits += int((top_labels[:, :5] == true_labels[:, None]).any(axis=1).sum())
+
+    def summary(self):
+        correct = np.diag(self.matrix)
+        count = self.matrix.sum(axis=1)
+        predicted = self.matrix.sum(axis=0)
+        total = max(int(count.sum()), 1)
+        return {
+            'count': int(count.sum()),
+            'top1': float(correct.sum()) / total,
+            'top5': float(self.top5_hits) / total,
+            'recall': (correct / np.maximum(count, 1)).tolist(),
+            'precision': (correct / np.maximum(predicted, 1)).tolist(),
+        }
+
+    def save(self, prefix):
+        np.savez_compressed(prefix + '.npz', matrix=self.matrix, top5_hits=self.top5_hits)
+        with open(prefix + '.json', 'w') as f:
+            json.dump(self.summary(), f)
+
+
 def main(argv=None):
     print("This script is used to compute accuracy!")
     if len(argv) < 2:
@@ -38,6 +82,11 @@ def main(argv=None):
     batch_shape = [FLAGS.batch_size, FLAGS.image_height, FLAGS.image_width, 3]
     nb_classes = FLAGS.num_classes
 
+    # the decode workers are forked before the graph and session exist
+    decode_pool = None
+    if FLAGS.num_loader_workers > 0:
+        decode_pool = DecodePool(batch_shape, FLAGS.num_loader_workers, FLAGS.loader_prefetch)
+
     tf.logging.set_verbosity(tf.logging.INFO)
     config = tf.ConfigProto()
     # allocate 50% of GPU memory
@@ -52,7 +101,7 @@ def main(argv=None):
         with slim.arg_scope(inception.inception_v1_arg_scope()):
             _, end_points = inception.inception_v1(
                 noise_input, num_classes=nb_classes, is_training=False)
-        predicted_labels = tf.argmax(end_points['Predictions'], 1)
+        _, top_labels = tf.nn.top_k(end_points['Predictions'], k=5)
 
         print("Restore Model...")
         saver = tf.train.Saver(slim.get_model_variables())
@@ -73,35 +122,29 @@ def main(argv=None):
                 INPUT_DIR = FLAGS.adv_data_dir
                 FLAGS.output_file = './result/adversarial_accuracy.txt'
 
-            data_generator = load_path_label(INPUT_DIR, batch_shape, shuffle=False)
+            data_generator = load_path_label(INPUT_DIR, batch_shape, shuffle=False, pool=decode_pool)
 
-            acc_dict = {}
-            for i in range(FLAGS.num_classes):
-                acc_dict[i] = [0, 0]
-                
+            confusion = ConfusionMatrix(FLAGS.num_classes)
             for images, true_labels, _ in tqdm(data_generator):
-                labels = sess.run(predicted_labels, feed_dict={x_input: images})
-                for i in range(len(true_labels)):
-                    acc_dict[true_labels[i]][1] += 1
-                    if labels[i] == true_labels[i]:
-                        acc_dict[true_labels[i]][0] += 1
+                confusion.update(true_labels, sess.run(top_labels, feed_dict={x_input: images}))
             
             print("Compute accuracy...")
+            summary = confusion.summary()
+            correct = np.diag(confusion.matrix)
+            count = confusion.matrix.sum(axis=1)
+            # per-class text lines are kept for plot_acc.py
             with open(FLAGS.output_file, 'w') as f:
-                total_true = 0
-                total_count = 0
                 for i in range(FLAGS.num_classes):
-                    total_true += acc_dict[i][0]
-                    total_count += acc_dict[i][1]
-                    if acc_dict[i][1] == 0:
-                        f.writelines("class: %d, accuracy: %d/%d = %.3f \n" % (i, acc_dict[i][0], acc_dict[i][1], 0))
-                    else:
-                        f.writelines("class: %d, accuracy: %d/%d = %.3f \n" % (i, acc_dict[i][0], acc_dict[i][1], acc_dict[i][0] / acc_dict[i][1]))
+                    f.writelines("class: %d, accuracy: %d/%d = %.3f \n" % (i, correct[i], count[i], summary['recall'][i]))
                 
-                print("Total accuracy: %.3f \n" % (total_true / total_count))
-                f.writelines("Total accuracy: %.3f \n" % (total_true / total_count))
+                print("Total accuracy: %.3f \n" % summary['top1'])
+                f.writelines("Total accuracy: %.3f \n" % summary['top1'])
+            print("Top-5 accuracy: %.3f \n" % summary['top5'])
+            confusion.save(os.path.splitext(FLAGS.output_file)[0])
             
             print('Save accuracy result to %s' %FLAGS.output_file)
+    if decode_pool is not None:
+        decode_pool.close()
 
 
 if __name__ == '__main__':
@@ -12,23 +12,82 @@ except ImportError:
     import Queue as queue
 
 
+def _align(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _pack(obj, buf, offset):
+    """Copies the numpy arrays of `obj` into `buf` starting at `offset`.
+
+    Returns a small picklable layout describing where everything went and
+    the offset after the last array. Lists of arrays that share a shape and
+    dtype are written as one stacked array. Objects that are not arrays, or
+    arrays that do not fit, are carried in the layout itself.
+    """
+    if isinstance(obj, np.ndarray):
+        start = _align(offset)
+        if start + obj.nbytes <= len(buf):
+            buf[start:start + obj.nbytes].view(obj.dtype).reshape(obj.shape)[...] = obj
+            return ('array', obj.dtype.str, obj.shape, start), start + obj.nbytes
+        return ('object', obj), offset
+    if isinstance(obj, (list, tuple)):
+        if len(obj) > 0 and all(isinstance(x, np.ndarray) and x.shape == obj[0].shape and
+                                x.dtype == obj[0].dtype for x in obj):
+            start = _align(offset)
+            nbytes = obj[0].nbytes * len(obj)
+            if start + nbytes <= len(buf):
+                view = buf[start:start + nbytes].view(obj[0].dtype).reshape((len(obj),) + obj[0].shape)
+                for i, x in enumerate(obj):
+                    view[i] = x
+                return ('array', obj[0].dtype.str, view.shape, start), start + nbytes
+        layouts = []
+        for x in obj:
+            layout, offset = _pack(x, buf, offset)
+            layouts.append(layout)
+        return (type(obj).__name__, layouts), offset
+    return ('object', obj), offset
+
+
+def _unpack(layout, buf):
+    kind = layout[0]
+    if kind == 'array':
+        _, dtype, shape, start = layout
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return buf[start:start + nbytes].view(dtype).reshape(shape)
+    if kind == 'list':
+        return [_unpack(x, buf) for x in layout[1]]
+    if kind == 'tuple':
+        return tuple(_unpack(x, buf) for x in layout[1])
+    return layout[1]
+
+
 class GeneratorEnqueuer():
     """Builds a queue out of a data generator.
 
     Used in `fit_generator`, `evaluate_generator`, `predict_generator`.
 
+    With threads, batches go through a bounded `queue.Queue` with blocking
+    `put()`/`get()`. With multiprocessing, workers write the numpy arrays of
+    each batch into a ring of `max_queue_size` shared memory slots and only
+    send the slot index and a small layout over a queue, so batches are not
+    pickled. `get()` then yields zero-copy views into the slot, which stay
+    valid until the next batch is requested.
+
     # Arguments
         generator: a generator function which endlessly yields data
         use_multiprocessing: use multiprocessing if True, otherwise threading
-        wait_time: time to sleep in-between calls to `put()`
+        wait_time: kept for backward compatibility, nothing polls anymore
         random_seed: Initial seed for workers,
             will be incremented by one for each workers.
+        slot_bytes: size of each shared memory slot in multiprocessing mode
     """
 
     def __init__(self, generator,
                  use_multiprocessing=False,
                  wait_time=0.05,
-                 random_seed=None):
+                 random_seed=None,
+                 slot_bytes=128 * 1024 * 1024):
         self.wait_time = wait_time
         self._generator = generator
         self._use_multiprocessing = use_multiprocessing
@@ -36,34 +95,75 @@ class GeneratorEnqueuer():
         self._stop_event = None
         self.queue = None
         self.random_seed = random_seed
+        self.slot_bytes = slot_bytes
+        self._generator_lock = threading.Lock()
+        self._slots = None
+        self._free_slots = None
+        self._produced = None
+        self._stall_time = None
+        self._consumed = 0
 
     def start(self, workers=1, max_queue_size=10):
         """Kicks off threads which add data from the generator into the queue.
 
         # Arguments
             workers: number of worker threads
-            max_queue_size: queue size
-                (when full, threads could block on `put()`)
+            max_queue_size: queue size in batches
+                (when full, workers block until a batch is consumed)
         """
 
         def data_generator_task():
             while not self._stop_event.is_set():
                 try:
-                    if self._use_multiprocessing or self.queue.qsize() < max_queue_size:
+                    with self._generator_lock:
                         generator_output = next(self._generator)
-                        self.queue.put(generator_output)
-                    else:
-                        time.sleep(self.wait_time)
+                    start = time.time()
+                    self.queue.put(generator_output)
+                    with self._stall_time.get_lock():
+                        self._stall_time.value += time.time() - start
+                    with self._produced.get_lock():
+                        self._produced.value += 1
                 except Exception:
                     self._stop_event.set()
+                    try:
+                        self.queue.put_nowait(None)
+                    except queue.Full:
+                        pass
+                    raise
+
+        def shared_memory_task():
+            buffers = [np.frombuffer(slot, dtype=np.uint8) for slot in self._slots]
+            while not self._stop_event.is_set():
+                try:
+                    generator_output = next(self._generator)
+                    start = time.time()
+                    slot = self._free_slots.get()
+                    with self._stall_time.get_lock():
+                        self._stall_time.value += time.time() - start
+                    if slot is None:
+                        break
+                    layout, _ = _pack(generator_output, buffers[slot], 0)
+                    with self._produced.get_lock():
+                        self._produced.value += 1
+                    self.queue.put((slot, layout))
+                except Exception:
+                    self._stop_event.set()
+                    self.queue.put(None)
                     raise
 
         try:
+            self._produced = multiprocessing.Value('l', 0)
+            self._stall_time = multiprocessing.Value('d', 0.0)
+            self._consumed = 0
             if self._use_multiprocessing:
-                self.queue = multiprocessing.Queue(maxsize=max_queue_size)
+                self._slots = [multiprocessing.RawArray('B', self.slot_bytes) for _ in range(max_queue_size)]
+                self._free_slots = multiprocessing.Queue()
+                for slot in range(max_queue_size):
+                    self._free_slots.put(slot)
+                self.queue = multiprocessing.Queue()
                 self._stop_event = multiprocessing.Event()
             else:
-                self.queue = queue.Queue()
+                self.queue = queue.Queue(maxsize=max_queue_size)
                 self._stop_event = threading.Event()
 
             for _ in range(workers):
@@ -71,12 +171,13 @@ class GeneratorEnqueuer():
                     # Reset random seed else all children processes
                     # share the same seed
                     np.random.seed(self.random_seed)
-                    thread = multiprocessing.Process(target=data_generator_task)
+                    thread = multiprocessing.Process(target=shared_memory_task)
                     thread.daemon = True
                     if self.random_seed is not None:
                         self.random_seed += 1
                 else:
                     thread = threading.Thread(target=data_generator_task)
+                    thread.daemon = True
                 self._threads.append(thread)
                 thread.start()
         except:
@@ -86,6 +187,14 @@ class GeneratorEnqueuer():
     def is_running(self):
         return self._stop_event is not None and not self._stop_event.is_set()
 
+    def metrics(self):
+        """Returns the number of batches waiting in the queue and the
+        total time workers spent blocked on a full queue, in seconds."""
+        if self._produced is None:
+            return {'queue_depth': 0, 'producer_stall_time': 0.0}
+        return {'queue_depth': self._produced.value - self._consumed,
+                'producer_stall_time': self._stall_time.value}
+
     def stop(self, timeout=None):
         """Stops running threads and wait for them to exit, if necessary.
 
@@ -102,28 +211,54 @@ class GeneratorEnqueuer():
                 if self._use_multiprocessing:
                     thread.terminate()
                 else:
+                    # unblock producers waiting on a full queue
+                    while not self.queue.empty():
+                        self.queue.get_nowait()
                     thread.join(timeout)
 
         if self._use_multiprocessing:
             if self.queue is not None:
                 self.queue.close()
+            if self._free_slots is not None:
+                self._free_slots.close()
 
         self._threads = []
         self._stop_event = None
         self.queue = None
+        self._slots = None
+        self._free_slots = None
 
     def get(self):
         """Creates a generator to extract data from the queue.
 
-        Skip the data if it is `None`.
+        Skip the data if it is `None`. Blocks until a batch is ready.
 
         # Returns
             A generator
         """
-        while self.is_running():
-            if not self.queue.empty():
+        if not self._use_multiprocessing:
+            while self.is_running():
                 inputs = self.queue.get()
                 if inputs is not None:
+                    self._consumed += 1
                     yield inputs
-            else:
-                time.sleep(self.wait_time)
\ No newline at end of file
+            return
+
+        buffers = [np.frombuffer(slot, dtype=np.uint8) for slot in self._slots]
+        free_slots = self._free_slots
+        slot = None
+        try:
+            while self.is_running():
+                # the previous batch has been consumed, its slot can be refilled
+                if slot is not None:
+                    free_slots.put(slot)
+                    slot = None
+                inputs = self.queue.get()
+                if inputs is None:
+                    continue
+                slot, layout = inputs
+                self._consumed += 1
+                yield _unpack(layout, buffers[slot])
+        finally:
+            if slot is not None and self._free_slots is not None:
+                free_slots.put(slot)
@@ -4,11 +4,11 @@ import numpy as np
 from scipy.misc import imread
 from scipy.misc import imresize
 import matplotlib.pyplot as plt
-from collections import deque
-import random
 from tensorflow.contrib.slim.nets import inception
 import time
 from mytools import load_path_label
+from replay_memory import Memory
+from async_saver import AsyncSaver
 # import pdb
 
 
@@ -44,6 +44,8 @@ tf.flags.DEFINE_integer(
     'image_height', 224, 'Height of each input images.')
 tf.flags.DEFINE_integer(
     'batch_size', 32, 'Batch size to processing images')
+tf.flags.DEFINE_integer(
+    'num_envs', 8, 'The number of images attacked at once')
 tf.flags.DEFINE_integer(
     'nb_pixel', 224*224*3, 'The number of pixelx in a image')
 tf.flags.DEFINE_integer(
@@ -305,23 +307,6 @@ class Critic(object):
                 self.sess.run(self.hard_replacement)
             self.t_replace_counter += 1
 
-#####################  Memory  ####################
-class Memory(object):
-    def __init__(self, capacity):
-        self.capacity = capacity
-        self.data = deque()
-
-    def store_transition(self, s, a, r, s_):
-        self.data.append((s, a, r, s_))
-        if len(self.data) > self.capacity:
-            self.data.popleft()
-
-    def sample(self, n):
-        # assert len(self.data)>= self.capacity, 'Memory has not been fulfilled'
-        # indices = np.random.choice(self.capacity, size=n)
-        # return self.data[indices, :]
-        return random.sample(self.data, n)
-
 #####################  Load Image  ####################
 def load_images(input_dir):
     for filepath in tf.gfile.Glob(os.path.join(input_dir, '*.jpg')):
@@ -361,17 +346,14 @@ class Classifier(object):
             self.sess = tf.train.MonitoredSession(session_creator=session_creator)
 
     def get_reward(self, s, a, labels):
+        # per-sample reward, L2 distance and predicted label for the whole batch
         pre_labels = self.sess.run(self.pre_labels, feed_dict={self.x_input: a})
 
-        if pre_labels[0] == labels[0]:
-            r = -1
-        else:
-            l2_dist = np.linalg.norm((a - s + 1.0) * 255.0 / 2.0)
-            if l2_dist >= 128:
-                r = -1
-            else:
-                r = -np.power(2.0, l2_dist / 128.0) + 2.0
-        return r
+        batch_size = len(a)
+        l2_dist = np.linalg.norm(((a - s + 1.0) * 255.0 / 2.0).reshape(batch_size, -1), axis=1)
+        r = np.where(l2_dist >= 128, -1.0, -np.power(2.0, l2_dist / 128.0) + 2.0)
+        r = np.where(pre_labels == labels, -1.0, r)
+        return r, l2_dist, pre_labels
     
     def extract_feature(self, images):
         return self.sess.run(self.features, feed_dict={self.x_input: images})
@@ -402,6 +384,8 @@ if __name__ == "__main__":
     sess.run(tf.global_variables_initializer())
     ac_var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, 'Actor') + tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='Critic')
     ac_saver = tf.train.Saver(ac_var_list, max_to_keep=3)
+    # checkpoints are written on a background thread, ac_saver only restores
+    ac_async_saver = AsyncSaver(ac_var_list, max_to_keep=3)
     if not tf.gfile.Exists(FLAGS.ddpg_checkpoint_path):
         tf.gfile.MkDir(FLAGS.ddpg_checkpoint_path)
     else:
@@ -419,11 +403,17 @@ if __name__ == "__main__":
     # var = 3.0  # control exploration
 
     start = time.time()
+    image_cnt = 0
     for episode in range(FLAGS.max_ep_steps):
         ep_reward = 0.0
-        data_generator = load_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3])
-        for step in range(FLAGS.max_steps):
-            (images, labels, filepaths) = next(data_generator)
+        # every image is a one-step episode, so num_envs of them go through the actor and the classifier together
+        data_generator = load_path_label(FLAGS.input_dir, [FLAGS.num_envs, FLAGS.image_height, FLAGS.image_width, 3])
+        for step, (images, labels, filepaths) in enumerate(data_generator):
+            if step >= FLAGS.max_steps:
+                break
+            # the last batch is padded, only the first len(labels) rows are images
+            n = len(labels)
+            images = images[:n]
             # use feature as state
             features = classifier.extract_feature(images)
             actions = actor.choose_action(features)
@@ -431,41 +421,43 @@ if __name__ == "__main__":
             # Add exploration noise
             # a = np.clip(np.random.normal(a, var), -1, 1)    # add randomness to action selection for exploration
             # s_, r, done, info = env.step(a)
-            r = classifier.get_reward(images, actions, labels)
+            r = classifier.get_reward(images, actions, labels)[0]
 
-            if r >= 0.0:
+            for i in np.flatnonzero(r >= 0.0):
                 f = plt.figure()
                 f.add_subplot(1, 2, 1)
-                plt.imshow((images[0] + 1.0) / 2.0)
+                plt.imshow((images[i] + 1.0) / 2.0)
                 f.add_subplot(1, 2, 2)
-                plt.imshow((actions[0] + 1.0) / 2.0)
+                plt.imshow((actions[i] + 1.0) / 2.0)
                 # plt.show(block=True)
-                plt.savefig(FLAGS.output_dir+filepaths[0].split('/')[-1].split('.')[0]+'.png')
+                plt.savefig(FLAGS.output_dir+filepaths[i].split('/')[-1].split('.')[0]+'.png')
 
-            M.store_transition(features[0], actions[0], r, classifier.extract_feature(actions)[0])
+            M.store_batch(features, actions, r, classifier.extract_feature(actions))
 
-            if episode > 0 or step > MEMORY_CAPACITY/10:
-                # var *= .9995    # decay the action randomness
-                minibatch = M.sample(FLAGS.batch_size)
-                b_s = [row[0] for row in minibatch]
-                b_a = [row[1] for row in minibatch]
-                b_r = [row[2] for row in minibatch]
-                b_s_ = [row[3] for row in minibatch]
+            if episode > 0 or len(M) > MEMORY_CAPACITY/10:
+                # one learning step per stored transition, as with one image at a time
+                for _ in range(n):
+                    # var *= .9995    # decay the action randomness
+                    b_s, b_a, b_r, b_s_ = M.sample(FLAGS.batch_size)
 
-                critic.learn(b_s, b_a, b_r, b_s_)
-                actor.learn(b_s)
+                    critic.learn(b_s, b_a, b_r, b_s_)
+                    actor.learn(b_s)
 
             # s = s_
-            ep_reward += r
+            ep_reward += r.sum()
 
             if step % 10 == 0:
                 avg_time_per_step = (time.time() - start)/10
-                avg_examples_per_second = (10 * FLAGS.batch_size) /(time.time() - start)
+                avg_examples_per_second = (10 * FLAGS.num_envs) /(time.time() - start)
                 start = time.time()
-                print('Episode:{}, Step {:06d}, {:.2f} seconds/step, {:.2f} examples/second, cur_reward: {:.3f}, ep_reward: {:.3f}, Explore: {:.3f}'.format(
+                print('Episode:{}, Step {:06d}, {:.2f} seconds/step, {:.2f} examples/second, mean reward: {:.3f}, ep_reward: {:.3f}, Explore: {:.3f}'.format(
                     episode, step, avg_time_per_step,
-                    avg_examples_per_second, r, ep_reward, 0))
-            if (step + 1) % 10000 == 0:
-                ac_saver.save(sess, FLAGS.ddpg_checkpoint_path+"model", global_step=episode)
+                    avg_examples_per_second, r.mean(), ep_reward, 0))
+            image_cnt += n
+            if image_cnt // 10000 > (image_cnt - n) // 10000:
+                ac_async_saver.save(sess, FLAGS.ddpg_checkpoint_path+"model", global_step=episode)
+                if ac_async_saver.latencies:
+                    print('Checkpoint snapshot: {:.3f} seconds, write: {:.3f} seconds'.format(*ac_async_saver.latencies[-1]))
         
-        print('Running time: ', time.time() - start)
\ No newline at end of file
+        print('Running time: ', time.time() - start)
+    ac_async_saver.close()
@@ -5,11 +5,11 @@ from scipy.misc import imread
 from scipy.misc import imresize
 # from scipy.misc import imsave
 import matplotlib.pyplot as plt
-from collections import deque
-import random
 from tensorflow.contrib.slim.nets import inception
 import time
-from mytools import load_path_label
+from mytools import cycle_path_label
+from replay_memory import Memory
+from async_saver import AsyncSaver
 # import pdb
 
 
@@ -45,6 +45,8 @@ tf.flags.DEFINE_integer(
     'image_height', 224, 'Height of each input images.')
 tf.flags.DEFINE_integer(
     'batch_size', 32, 'Batch size to processing images')
+tf.flags.DEFINE_integer(
+    'num_envs', 8, 'The number of images attacked in lockstep')
 tf.flags.DEFINE_integer(
     'nb_pixel', 224*224*3, 'The number of pixelx in a image')
 tf.flags.DEFINE_integer(
@@ -286,20 +288,6 @@ class Critic(object):
                 self.sess.run(self.hard_replacement)
             self.t_replace_counter += 1
 
-#####################  Memory  ####################
-class Memory(object):
-    def __init__(self, capacity):
-        self.capacity = capacity
-        self.data = deque()
-
-    def store_transition(self, s, a, r, s_):
-        self.data.append((s, a, r, s_))
-        if len(self.data) > self.capacity:
-            self.data.popleft()
-
-    def sample(self, n):
-        return random.sample(self.data, n)
-
 #####################  Load Image  ####################
 def load_images(input_dir):
     for filepath in tf.gfile.Glob(os.path.join(input_dir, '*.jpg')):
@@ -339,21 +327,52 @@ class Classifier(object):
             self.sess = tf.train.MonitoredSession(session_creator=session_creator)
 
     def get_reward(self, images, a, labels):
+        # per-sample reward, L2 distance and predicted label for the whole batch
         pre_labels = self.sess.run(self.pre_labels, feed_dict={self.x_input: a})
 
-        if pre_labels[0] == labels[0]:
-            r = -1
-        else:
-            l2_dist = np.linalg.norm((a - images + 1.0) * 255.0 / 2.0)
-            if l2_dist >= 128:
-                r = -1
-            else:
-                r = -np.power(2.0, l2_dist / 128.0) + 2.0
-        return r
+        batch_size = len(a)
+        l2_dist = np.linalg.norm(((a - images + 1.0) * 255.0 / 2.0).reshape(batch_size, -1), axis=1)
+        r = np.where(l2_dist >= 128, -1.0, -np.power(2.0, l2_dist / 128.0) + 2.0)
+        r = np.where(pre_labels == labels, -1.0, r)
+        return r, l2_dist, pre_labels
     
     def extract_feature(self, images):
         return self.sess.run(self.features, feed_dict={self.x_input: images})
 
+#####################  Environment  ####################
+class BatchEnv(object):
+    """Runs `num_envs` attack episodes in lockstep.
+
+    Every slot holds one image and the features of its clean image. Slots
+    whose episode is done are refilled from `data_generator` by `reset`,
+    so the actor and the classifier always work on a full batch.
+    """
+    def __init__(self, classifier, data_generator, num_envs):
+        self.classifier = classifier
+        self.data_generator = data_generator
+        self.num_envs = num_envs
+        self.labels = np.zeros(num_envs, dtype=np.int64)
+        self.filepaths = [None] * num_envs
+        self.images = None
+        self.features = None
+        self.reset(np.arange(num_envs))
+
+    def reset(self, slots):
+        """Loads the next image into each of `slots`."""
+        if len(slots) == 0:
+            return
+        images, labels, filepaths = zip(*[next(self.data_generator) for _ in slots])
+        images = np.concatenate(images).astype(np.float32)
+        features = self.classifier.extract_feature(images)
+        if self.images is None:
+            self.images = np.zeros((self.num_envs,) + images.shape[1:], dtype=np.float32)
+            self.features = np.zeros((self.num_envs,) + features.shape[1:], dtype=np.float32)
+        self.images[slots] = images
+        self.features[slots] = features
+        self.labels[slots] = [x[0] for x in labels]
+        for i, x in zip(slots, filepaths):
+            self.filepaths[i] = x[0]
+
 #####################  Main  ####################
 if __name__ == "__main__":
     state_dim = [7, 7, 1024]
@@ -376,6 +395,8 @@ if __name__ == "__main__":
     sess.run(tf.global_variables_initializer())
     ac_var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, 'Actor') + tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='Critic')
     ac_saver = tf.train.Saver(ac_var_list, max_to_keep=3)
+    # checkpoints are written on a background thread, ac_saver only restores
+    ac_async_saver = AsyncSaver(ac_var_list, max_to_keep=3)
     if not tf.gfile.Exists(FLAGS.ddpg_checkpoint_path):
         tf.gfile.MkDir(FLAGS.ddpg_checkpoint_path)
     else:
@@ -388,50 +409,52 @@ if __name__ == "__main__":
     M = Memory(MEMORY_CAPACITY)
 
     start = time.time()
-    data_generator = load_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3])
-    for episode in range(FLAGS.max_ep_steps):
-        ep_reward = 0.0
-        step = 0
-        done = False
-        (images, labels, filepaths) = next(data_generator)
-        features = classifier.extract_feature(images)
-        while not done:
-            actions = actor.choose_action(features)
-
-            r = classifier.get_reward(images, actions, labels)
-            if r > 0.0:
-                f = plt.figure()
-                f.add_subplot(1, 2, 1)
-                plt.imshow((images[0] + 1.0) / 2.0)
-                f.add_subplot(1, 2, 2)
-                plt.imshow((actions[0] + 1.0) / 2.0)
-                # plt.show(block=True)
-                plt.savefig(FLAGS.output_dir + filepaths[0].split('/')[-1].split('.')[0] + '.png')
-                done = True
-
-            M.store_transition(features[0], actions[0], r, classifier.extract_feature(actions)[0])
-
-            if episode > 0 or step > MEMORY_CAPACITY / 10:
-                minibatch = M.sample(FLAGS.batch_size)
-                b_s = [row[0] for row in minibatch]
-                b_a = [row[1] for row in minibatch]
-                b_r = [row[2] for row in minibatch]
-                b_s_ = [row[3] for row in minibatch]
+    env = BatchEnv(classifier, cycle_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3]), FLAGS.num_envs)
+    ep_reward = np.zeros(FLAGS.num_envs)
+    episode = 0
+    step = 0
+    while episode < FLAGS.max_ep_steps:
+        actions = actor.choose_action(env.features)
+
+        r = classifier.get_reward(env.images, actions, env.labels)[0]
+        done = r > 0.0
+        for i in np.flatnonzero(done):
+            f = plt.figure()
+            f.add_subplot(1, 2, 1)
+            plt.imshow((env.images[i] + 1.0) / 2.0)
+            f.add_subplot(1, 2, 2)
+            plt.imshow((actions[i] + 1.0) / 2.0)
+            # plt.show(block=True)
+            plt.savefig(FLAGS.output_dir + env.filepaths[i].split('/')[-1].split('.')[0] + '.png')
+
+        M.store_batch(env.features, actions, r, classifier.extract_feature(actions))
+
+        if episode > 0 or len(M) > MEMORY_CAPACITY / 10:
+            # one learning step per stored transition, as with one image at a time
+            for _ in range(FLAGS.num_envs):
+                b_s, b_a, b_r, b_s_ = M.sample(FLAGS.batch_size)
 
                 critic.learn(b_s, b_a, b_r, b_s_)
                 actor.learn(b_s)
 
-            ep_reward += r
-
-            if step % 10 == 0:
-                avg_time_per_step = (time.time() - start)/10
-                avg_examples_per_second = (10 * FLAGS.batch_size) /(time.time() - start)
-                start = time.time()
-                print('Episode:{}, Step {:06d}, {:.2f} seconds/step, {:.2f} examples/second, cur_reward: {:.3f}, ep_reward: {:.3f}, Explore: {:.3f}'.format(
-                    episode, step, avg_time_per_step,
-                    avg_examples_per_second, r, ep_reward, 0))
-            
-            step += 1
-        ac_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=episode)
+        ep_reward += r
+
+        if step % 10 == 0:
+            avg_time_per_step = (time.time() - start)/10
+            avg_examples_per_second = (10 * FLAGS.num_envs) /(time.time() - start)
+            start = time.time()
+            print('Episode:{}, Step {:06d}, {:.2f} seconds/step, {:.2f} examples/second, mean reward: {:.3f}, mean ep_reward: {:.3f}, Explore: {:.3f}'.format(
+                episode, step, avg_time_per_step,
+                avg_examples_per_second, r.mean(), ep_reward.mean(), 0))
+
+        step += 1
+        if done.any():
+            episode += done.sum()
+            ep_reward[done] = 0.0
+            env.reset(np.flatnonzero(done))
+            ac_async_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=episode)
+            if ac_async_saver.latencies:
+                print('Checkpoint snapshot: {:.3f} seconds, write: {:.3f} seconds'.format(*ac_async_saver.latencies[-1]))
         
-        print('Running time: ', time.time() - start)
\ No newline at end of file
+            print('Running time: ', time.time() - start)
+    ac_async_saver.close()
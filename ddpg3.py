@@ -1,15 +1,22 @@
 import os
+import random
+import multiprocessing
 import tensorflow as tf
 import numpy as np
 from scipy.misc import imread
 from scipy.misc import imresize
 import matplotlib.pyplot as plt
-from collections import deque
-import random
 from tensorflow.contrib.slim.nets import inception
 import time
-from mytools import load_path_label
+import json
+from mytools import load_path_label, image_store_valid, build_image_store, checkpoint_fingerprint, FeatureStore, BackgroundWriter
+from replay_memory import Memory, PrioritizedMemory, TransitionSlots
+from async_saver import AsyncSaver
 from PIL import Image
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 np.random.seed(1)
@@ -21,6 +28,10 @@ tf.flags.DEFINE_float('LR_A', 0.001, 'learning rate for actor')
 tf.flags.DEFINE_float('LR_C', 0.001, 'learning rate for critic')
 tf.flags.DEFINE_float('GAMMA', 0.9, 'reward discount')
 tf.flags.DEFINE_integer('MEMORY_CAPACITY', 20000, '')
+tf.flags.DEFINE_string('memory_dir', '', 'Directory of the memory-mapped replay memory kept across restarts, empty to keep it in RAM')
+tf.flags.DEFINE_boolean('share_states', False, 'Store each state once and let consecutive transitions reference it')
+tf.flags.DEFINE_boolean('prioritized_replay', False, 'Sample transitions in proportion to their TD error')
+tf.flags.DEFINE_string('memory_storage', 'float32', 'How the replay memory keeps states and actions: float32, float16 or int8')
 tf.flags.DEFINE_list('REPLACEMENT', [
     dict(name='soft', tau=0.01),
     dict(name='hard', rep_iter_a=600, rep_iter_c=500)
@@ -33,11 +44,21 @@ tf.flags.DEFINE_string('input_dir', './datasets/train_labels.txt', 'Input direct
 tf.flags.DEFINE_string('output_plt_dir', './output-example3/', 'Output directory to save plot images.')
 tf.flags.DEFINE_string('output_adv_dir', './datasets/adversarial-examples', 'Output directory to save adversarial image.')
 tf.flags.DEFINE_string('output_file', './output-defense.txt', 'Output file to save labels.')
+tf.flags.DEFINE_boolean('raw_output', False, 'Save adversarial examples as .npy arrays with .json metadata instead of plots and JPEGs')
+tf.flags.DEFINE_integer('num_writers', 2, 'Worker processes that save adversarial examples, 0 to save them inline')
+tf.flags.DEFINE_string('image_store_dir', '', 'Directory of the pre-decoded uint8 image store, empty to decode images on the fly.')
+tf.flags.DEFINE_string('feature_cache_dir', './cache/features/', 'Directory to cache clean image features, empty to disable.')
 tf.flags.DEFINE_integer('image_width', 224, 'Width of each input images.')
 tf.flags.DEFINE_integer('image_height', 224, 'Height of each input images.')
 tf.flags.DEFINE_integer('batch_size', 32, 'Batch size to processing images')
+tf.flags.DEFINE_integer('num_envs', 8, 'The number of images attacked in lockstep')
+tf.flags.DEFINE_boolean('single_graph', False, 'Build the classifier into the actor/critic graph and session')
 tf.flags.DEFINE_integer('nb_pixel', 224*224*3, 'The number of pixelx in a image')
 tf.flags.DEFINE_integer('num_classes', 110, 'How many classes of the data set')
+tf.flags.DEFINE_integer('num_actors', 0, 'The number of actor processes feeding an asynchronous learner, 0 to step and learn in turn')
+tf.flags.DEFINE_string('sync_dir', './models/ddpg3/sync/', 'Directory the learner publishes actor weights to')
+tf.flags.DEFINE_integer('sync_every', 100, 'Learner steps between published actor weights, and actor steps between weight checks')
+tf.flags.DEFINE_integer('save_checkpoint_steps', 1000, 'Learner steps between checkpoints of the asynchronous learner')
 tf.flags.DEFINE_integer('max_ep_steps', 10000, 'The number of epoch times')
 tf.flags.DEFINE_integer('max_steps', 100000, 'The number of training times')
 FLAGS = tf.flags.FLAGS
@@ -67,13 +88,6 @@ class Actor(object):
         self.e_params = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='Actor/eval_net')
         self.t_params = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='Actor/target_net')
 
-        if self.replacement['name'] == 'hard':
-            self.t_replace_counter = 0
-            self.hard_replace = [tf.assign(t, e) for t, e in zip(self.t_params, self.e_params)]
-        else:
-            self.soft_replace = [tf.assign(t, (1 - self.replacement['tau']) * t + self.replacement['tau'] * e)
-                                 for t, e in zip(self.t_params, self.e_params)]
-
     def _build_net(self, s, scope, trainable):
         # use inception v1 end_points['Mixed_5c'] extract feature
         # s shape = [None, 7, 7, 1024]    
@@ -167,21 +181,12 @@ class Actor(object):
 
         return actions
 
-    def learn(self, s):   # batch update
-        self.sess.run(self.train_op, feed_dict={S: s})
-
-        if self.replacement['name'] == 'soft':
-            self.sess.run(self.soft_replace)
-        else:
-            if self.t_replace_counter % self.replacement['rep_iter_a'] == 0:
-                self.sess.run(self.hard_replace)
-            self.t_replace_counter += 1
-
     def choose_action(self, s):
         return self.sess.run(self.a, feed_dict={S: s})
 
-    def add_grad_to_graph(self, a_grads):
-        with tf.variable_scope('policy_grads'):
+    def add_grad_to_graph(self, a_grads, control_inputs=None):
+        # control_inputs makes the actor update wait for the critic update
+        with tf.variable_scope('policy_grads'), tf.control_dependencies(control_inputs):
             # ys = policy;
             # xs = policy's parameters;
             # a_grads = the gradients of the policy to get more Q
@@ -207,6 +212,7 @@ class Critic(object):
             self.a = tf.stop_gradient(a)    # stop critic update flows to actor
             self.q = self._build_net(S, self.a, 'eval_net', trainable=True)
 
+        with tf.variable_scope('Critic'):
             # Input (s_, a_), output q_ for q_target
             self.q_ = self._build_net(S_, a_, 'target_net', trainable=False)    # target_q is based on a_ from Actor's target_net
 
@@ -217,20 +223,25 @@ class Critic(object):
             self.target_q = R + self.gamma * self.q_
 
         with tf.variable_scope('TD_error'):
-            self.loss = tf.reduce_mean(tf.squared_difference(self.target_q, self.q))
+            # importance-sampling weights of prioritized replay, all ones for uniform replay
+            self.is_weights = tf.placeholder_with_default(tf.ones_like(self.q), [None, 1], name='is_weights')
+            self.abs_errors = tf.abs(self.target_q - self.q)
+            self.loss = tf.reduce_mean(self.is_weights * tf.squared_difference(self.target_q, self.q))
 
         with tf.variable_scope('C_train'):
             self.train_op = tf.train.AdamOptimizer(self.lr).minimize(self.loss)
 
-        with tf.variable_scope('a_grad'):
-            self.a_grads = tf.gradients(self.q, a)[0]   # tensor of gradients of each sample (None, a_dim)
+        # the policy gradient reads the critic weights again after C_train, the cached variable reads may run before it
+        def read_after_train(getter, *args, **kwargs):
+            return getter(*args, **kwargs).read_value()
 
-        if self.replacement['name'] == 'hard':
-            self.t_replace_counter = 0
-            self.hard_replacement = [tf.assign(t, e) for t, e in zip(self.t_params, self.e_params)]
-        else:
-            self.soft_replacement = [tf.assign(t, (1 - self.replacement['tau']) * t + self.replacement['tau'] * e)
-                                     for t, e in zip(self.t_params, self.e_params)]
+        with tf.control_dependencies([self.train_op]):
+            with tf.variable_scope('Critic', reuse=True, custom_getter=read_after_train):
+                # Input (s, actor's a), output q for the policy gradient, so self.a can be fed with stored actions in the same run
+                self.q_pi = self._build_net(S, a, 'eval_net', trainable=True)
+
+            with tf.variable_scope('a_grad'):
+                self.a_grads = tf.gradients(self.q_pi, a)[0]   # tensor of gradients of each sample (None, a_dim)
 
     def _build_net(self, s, a, scope, trainable):
         with tf.variable_scope(scope):
@@ -261,36 +272,66 @@ class Critic(object):
                 q = tf.layers.dense(net, 1, kernel_initializer=init_w, bias_initializer=init_b, trainable=trainable)   # Q(s,a)
         return q
 
-    def learn(self, s, a, r, s_):
-        self.sess.run(self.train_op, feed_dict={S: s, self.a: a, R: r, S_: s_})
-        if self.replacement['name'] == 'soft':
-            self.sess.run(self.soft_replacement)
-        else:
-            if self.t_replace_counter % self.replacement['rep_iter_c'] == 0:
-                self.sess.run(self.hard_replacement)
-            self.t_replace_counter += 1
 
-#####################  Memory  ####################
-class Memory(object):
-    def __init__(self, capacity):
-        self.capacity = capacity
-        self.data = deque()
+#####################  Agent  ####################
+class DDPGAgent(object):
+    """Trains the critic, then the actor, then updates both target nets in one run.
 
-    def store_transition(self, s, a, r, s_):
-        self.data.append((s, a, r, s_))
-        if len(self.data) > self.capacity:
-            self.data.popleft()
+    The control dependencies order the three updates inside the graph, so
+    `train_step` makes one session call with a single feed of the sampled
+    batch. Hard replacement stays on its own iteration schedule.
+    """
+    def __init__(self, sess, actor, critic, replacement):
+        self.sess = sess
+        self.actor = actor
+        self.critic = critic
+        self.replacement = replacement
+        self.t_replace_counter = 0
 
-    def sample(self, n):
-        return random.sample(self.data, n)
+        t_params = actor.t_params + critic.t_params
+        e_params = actor.e_params + critic.e_params
+        with tf.variable_scope('target_replace'):
+            if self.replacement['name'] == 'hard':
+                self.hard_replace_a = tf.group(*[tf.assign(t, e) for t, e in zip(actor.t_params, actor.e_params)])
+                self.hard_replace_c = tf.group(*[tf.assign(t, e) for t, e in zip(critic.t_params, critic.e_params)])
+                self.train_op = actor.train_op
+            else:
+                tau = self.replacement['tau']
+                with tf.control_dependencies([actor.train_op]):
+                    self.train_op = tf.group(*[tf.assign(t, (1 - tau) * t + tau * e.read_value()) for t, e in zip(t_params, e_params)])
+
+    def train_step(self, s, a, r, s_, is_weights=None):
+        feed_dict = {S: s, self.critic.a: a, R: r, S_: s_}
+        if is_weights is not None:
+            feed_dict[self.critic.is_weights] = is_weights
+        _, loss, abs_errors = self.sess.run([self.train_op, self.critic.loss, self.critic.abs_errors], feed_dict=feed_dict)
+        if self.replacement['name'] == 'hard':
+            if self.t_replace_counter % self.replacement['rep_iter_a'] == 0:
+                self.sess.run(self.hard_replace_a)
+            if self.t_replace_counter % self.replacement['rep_iter_c'] == 0:
+                self.sess.run(self.hard_replace_c)
+            self.t_replace_counter += 1
+        return loss, abs_errors
+
+    def learn(self, memory, batch_size):
+        """Trains on one minibatch sampled from `memory` and returns the critic loss."""
+        if isinstance(memory, PrioritizedMemory):
+            b_s, b_a, b_r, b_s_, b_idx, b_w = memory.sample(batch_size)
+            loss, abs_errors = self.train_step(b_s, b_a, b_r, b_s_, b_w)
+            memory.update_priorities(b_idx, abs_errors)
+        else:
+            b_s, b_a, b_r, b_s_ = memory.sample(batch_size)
+            loss, _ = self.train_step(b_s, b_a, b_r, b_s_)
+        return loss
 
 #####################  Prediction Model ####################
 class Classifier(object):
-    def __init__(self, input_shape, nb_classes):
+    def __init__(self, input_shape, nb_classes, config=None):
         # self.graph = tf.Graph()
         self.sess = None
         self.input_shape = input_shape
         self.nb_classes = nb_classes
+        self.config = config
         self.restore_model()
 
     def restore_model(self):
@@ -307,31 +348,433 @@ class Classifier(object):
             # Restore Model
             saver = tf.train.Saver(tf.contrib.slim.get_model_variables())
             session_creator = tf.train.ChiefSessionCreator(
+                config=self.config,
                 scaffold=tf.train.Scaffold(saver=saver),
                 checkpoint_filename_with_path=FLAGS.checkpoint_path)
             
             self.sess = tf.train.MonitoredSession(session_creator=session_creator)
 
     def get_reward(self, images, noise_images, labels, pred_val):
-        l2_dist = np.linalg.norm(images - noise_images)
-
         pre_labels, predictions = self.sess.run([self.pre_labels, self.predictions], feed_dict={self.x_input: noise_images})
-        
-        if pre_labels[0] == labels[0]:
-            r = (pred_val - predictions[0][labels[0]]) / pred_val
-        else:
-            r = (pred_val - predictions[0][labels[0]]) / pred_val + (FLAGS.MAX_L2-l2_dist)/FLAGS.MAX_L2
+        return self.compute_reward(images, noise_images, labels, pred_val, pre_labels, predictions)
+
+    def compute_reward(self, images, noise_images, labels, pred_val, pre_labels, predictions):
+        # per-sample reward, L2 distance and predicted label for the whole batch
+        l2_dist = np.linalg.norm((images - noise_images).reshape(len(images), -1), axis=1)
+        return self.reward_from_distance(l2_dist, labels, pred_val, pre_labels, predictions)
+
+    def reward_from_distance(self, l2_dist, labels, pred_val, pre_labels, predictions):
+        batch_size = len(l2_dist)
+        true_prob = predictions[np.arange(batch_size), labels]
+
+        r = (pred_val - true_prob) / pred_val
+        r = np.where(pre_labels == labels, r, r + (FLAGS.MAX_L2-l2_dist)/FLAGS.MAX_L2)
         return r, l2_dist, pre_labels
+
+    def step(self, images, noise_images, labels, pred_val):
+        # one forward pass gives both the reward and the next state
+        features, pre_labels, predictions = self.sess.run([self.features, self.pre_labels, self.predictions], feed_dict={self.x_input: noise_images})
+        r, l2_dist, pre_labels = self.compute_reward(images, noise_images, labels, pred_val, pre_labels, predictions)
+        return r, l2_dist, pre_labels, features
     
     def extract_feature(self, images):
         features, labels, predictions = self.sess.run([self.features, self.pre_labels, self.predictions], feed_dict={self.x_input: images})
-        return features, labels, predictions.max()
+        return features, labels, predictions.max(axis=1)
+
+class FusedClassifier(Classifier):
+    """Inception v1 built into the actor/critic graph and session.
+
+    The clean images, accumulated noise images and current states of the
+    `num_envs` env slots live in graph variables. `act` only feeds the
+    slots: a second tower of the actor reads their states, the clipped
+    action is added to their noise images and classified, and the new noise
+    images and states are scattered back in the same run. Only the actions,
+    the next states and the reward inputs are fetched, which is what replay
+    needs. Feeding `x_input` directly still classifies arbitrary images,
+    which keeps `extract_feature` and `step` working as in `Classifier`.
+    """
+    def __init__(self, sess, actor, input_shape, nb_classes, num_envs, state_dim):
+        self.sess = sess
+        self.input_shape = input_shape
+        self.nb_classes = nb_classes
+
+        with tf.variable_scope('Perturbation'):
+            image_shape = [num_envs] + input_shape[1:]
+            self.slot_images = tf.get_variable('images', image_shape, initializer=tf.zeros_initializer(), trainable=False)
+            self.slot_noise_images = tf.get_variable('noise_images', image_shape, initializer=tf.zeros_initializer(), trainable=False)
+            self.slot_states = tf.get_variable('states', [num_envs] + state_dim, initializer=tf.zeros_initializer(), trainable=False)
+            self.slots = tf.placeholder(tf.int32, shape=[None], name='slots')
+
+            # reset loads new clean images and their features into slots
+            self.new_images = tf.placeholder(tf.float32, shape=input_shape, name='new_images')
+            self.new_states = tf.placeholder(tf.float32, shape=[None] + state_dim, name='new_states')
+            self.reset_op = tf.group(tf.scatter_update(self.slot_images, self.slots, self.new_images),
+                                     tf.scatter_update(self.slot_noise_images, self.slots, self.new_images),
+                                     tf.scatter_update(self.slot_states, self.slots, self.new_states))
+
+            self.var = tf.placeholder_with_default(0.0, shape=[], name='var')
+        with tf.variable_scope('Actor', reuse=True):
+            a = actor._build_net(tf.gather(self.slot_states, self.slots), scope='eval_net', trainable=True)
+        with tf.variable_scope('Perturbation'):
+            actions = a + tf.random_normal(tf.shape(a), stddev=self.var)   # add randomness to action selection for exploration
+            self.actions = tf.clip_by_value(actions, -FLAGS.EPSILON, FLAGS.EPSILON)
+            self.noise_images = tf.gather(self.slot_noise_images, self.slots)
+            perturbed_images = tf.clip_by_value(self.noise_images + self.actions, -1, 1)
+            diff = tf.layers.flatten(tf.gather(self.slot_images, self.slots) - perturbed_images)
+            self.l2_dist = tf.sqrt(tf.reduce_sum(tf.square(diff), axis=1))
+        self.x_input = tf.placeholder_with_default(perturbed_images, shape=input_shape)
+
+        with tf.contrib.slim.arg_scope(inception.inception_v1_arg_scope()):
+            _, end_points = inception.inception_v1(self.x_input, num_classes=self.nb_classes, is_training=False)
+            self.pre_labels = tf.argmax(end_points['Predictions'], 1)
+            self.features = end_points['Mixed_5c']
+            self.predictions = end_points['Predictions']
+
+        with tf.variable_scope('Perturbation'):
+            self.update_op = tf.group(tf.scatter_update(self.slot_noise_images, self.slots, perturbed_images),
+                                      tf.scatter_update(self.slot_states, self.slots, self.features))
+
+    def restore_model(self):
+        # must run after global_variables_initializer
+        saver = tf.train.Saver(tf.contrib.slim.get_model_variables('InceptionV1'))
+        saver.restore(self.sess, FLAGS.checkpoint_path)
+
+    def reset(self, slots, images, features):
+        self.sess.run(self.reset_op, feed_dict={self.slots: slots, self.new_images: images, self.new_states: features})
+
+    def get_noise_images(self, slots):
+        return self.sess.run(self.noise_images, feed_dict={self.slots: slots})
+
+    def act(self, slots, labels, pred_val, var):
+        _, actions, features, l2_dist, pre_labels, predictions = self.sess.run(
+            [self.update_op, self.actions, self.features, self.l2_dist, self.pre_labels, self.predictions],
+            feed_dict={self.slots: slots, self.var: var})
+        r, l2_dist, pre_labels = self.reward_from_distance(l2_dist, labels, pred_val, pre_labels, predictions)
+        return actions, r, l2_dist, pre_labels, features
+
+#####################  Environment  ####################
+class BatchEnv(object):
+    """Runs `num_envs` attack episodes in lockstep.
+
+    Every slot holds one image and its accumulated perturbation. Slots whose
+    episode is done are refilled from `data_generator` by `reset`, so the
+    actor and the classifier always work on a full batch until the loader
+    runs dry at the end of an epoch.
+    """
+    def __init__(self, classifier, data_generator, num_envs, feature_store=None):
+        self.classifier = classifier
+        self.data_generator = data_generator
+        self.feature_store = feature_store
+        self.num_envs = num_envs
+        self.image_cnt = 0
+        self.active = np.zeros(num_envs, dtype=bool)
+        self.steps = np.zeros(num_envs, dtype=np.int64)
+        self.true_labels = np.zeros(num_envs, dtype=np.int64)
+        self.labels = np.zeros(num_envs, dtype=np.int64)
+        self.pred_val = np.zeros(num_envs, dtype=np.float32)
+        self.filepaths = [None] * num_envs
+        # replay memory ids of the current features, -1 until they are stored
+        self.state_refs = np.full(num_envs, -1, dtype=np.int64)
+        self.images = None
+        self.noise_images = None
+        self.features = None
+        self.reset(np.arange(num_envs))
+
+    def _allocate(self, images, features):
+        self.images = np.zeros((self.num_envs,) + images.shape[1:], dtype=np.float32)
+        self.noise_images = np.zeros_like(self.images)
+        self.features = np.zeros((self.num_envs,) + features.shape[1:], dtype=np.float32)
+
+    def reset(self, slots):
+        """Loads a new image into each of `slots`, deactivating them once the loader is exhausted."""
+        filled = []
+        new_images = []
+        new_filepaths = []
+        for i in slots:
+            try:
+                images, true_labels, filepaths = next(self.data_generator)
+            except StopIteration:
+                self.active[i] = False
+                continue
+            new_images.append(images[0])
+            self.true_labels[i] = true_labels[0]
+            self.filepaths[i] = filepaths[0]
+            new_filepaths.append(filepaths[0])
+            filled.append(i)
+        if not filled:
+            return
+
+        new_images = np.stack(new_images)
+        if self.feature_store is None:
+            features, labels, pred_val = self.classifier.extract_feature(new_images)
+        else:
+            features, labels, pred_val = self.feature_store.get(new_filepaths, new_images, self.classifier.extract_feature)
+        if self.images is None:
+            self._allocate(new_images, features)
+        self.images[filled] = new_images
+        self.noise_images[filled] = new_images
+        self.features[filled] = features
+        if isinstance(self.classifier, FusedClassifier):
+            self.classifier.reset(filled, new_images, features)
+        self.state_refs[filled] = -1
+        self.labels[filled] = labels
+        self.pred_val[filled] = pred_val
+        self.steps[filled] = 0
+        self.active[filled] = True
+        self.image_cnt += len(filled)
+
+    def observe(self):
+        slots = np.flatnonzero(self.active)
+        return slots, self.features[slots]
+
+    def step(self, slots, actions):
+        noise_images = np.clip(self.noise_images[slots] + actions, -1, 1)
+        r, l2_dist, pre_labels, features_ = self.classifier.step(self.images[slots], noise_images, self.labels[slots], self.pred_val[slots])
+        return self._advance(slots, noise_images, r, l2_dist, pre_labels, features_)
+
+    def act(self, slots, var):
+        """Chooses, applies and scores the actions in one run of a `FusedClassifier`.
+
+        The noise images stay in the graph, only those of successful attacks are fetched to be saved.
+        """
+        actions, r, l2_dist, pre_labels, features_ = self.classifier.act(slots, self.labels[slots], self.pred_val[slots], var)
+        result = self._advance(slots, None, r, l2_dist, pre_labels, features_)
+        success = result[4]
+        if success.any():
+            self.noise_images[slots[success]] = self.classifier.get_noise_images(slots[success])
+        return (actions,) + result
+
+    def _advance(self, slots, noise_images, r, l2_dist, pre_labels, features_):
+        if noise_images is not None:
+            self.noise_images[slots] = noise_images
+        self.features[slots] = features_
+        self.steps[slots] += 1
+
+        # an episode ends when the label flips or the perturbation grows too large
+        over_budget = l2_dist > FLAGS.MAX_L2
+        success = (pre_labels != self.labels[slots]) & ~over_budget
+        done = success | over_budget
+        return r, l2_dist, pre_labels, features_, success, done
+
+#####################  Output  ####################
+def save_adversarial_example(image, noise_image, true_label, label, pre_label, l2_dist, filepath):
+    name = filepath.split('/')[-1].split('.')[0]
+    ### save plot image ###
+    f = plt.figure(figsize=(12,4))
+    # original image
+    f.add_subplot(1, 3, 1)
+    plt.title('original image\ntrue label {}\npredicted label {}'.format(true_label, label))
+    plt.imshow((image + 1.0) / 2.0)
+    # cumulative noise
+    cumulative_noise = (noise_image - image + 1.0) / 2.0
+    f.add_subplot(1, 3, 2)
+    plt.title('noise\ndistance={:.3f}'.format(l2_dist))
+    plt.ylabel('+',rotation=0, fontsize=20, labelpad=20)
+    plt.imshow(cumulative_noise)
+    # noise image
+    f.add_subplot(1, 3, 3)
+    plt.title('adversarial image\npredicted label {}'.format(pre_label))
+    plt.imshow(np.clip((noise_image + 1) / 2.0, 0, 1))
+    plt.ylabel('=',rotation=0, fontsize=20, labelpad=20)
+    plt.tight_layout()
+    # plt.show(block=True)
+    plt.savefig(FLAGS.output_plt_dir + name + '.pdf', format='pdf')
+    plt.close()
+    ### save noise image for training ###
+    fn = '{}/{:05d}/{}.jpg'.format(FLAGS.output_adv_dir, true_label, name)
+    img = (((noise_image + 1.0) * 0.5) * 255.0).astype(np.uint8)
+    Image.fromarray(img).save(fn, format='JPEG')
+
+def save_raw_adversarial_example(image, noise_image, true_label, label, pre_label, l2_dist, filepath):
+    name = filepath.split('/')[-1].split('.')[0]
+    fn = '{}/{:05d}/{}'.format(FLAGS.output_adv_dir, true_label, name)
+    np.save(fn + '.npy', noise_image.astype(np.float32))
+    with open(fn + '.json', 'w') as f:
+        json.dump({'filepath': filepath, 'true_label': int(true_label), 'label': int(label),
+                   'pre_label': int(pre_label), 'l2_dist': float(l2_dist)}, f)
+
+#####################  Async  ####################
+def run_actor(actor_id, state_dim, action_dim, transitions, env_steps, stop):
+    """Attacks images with the latest published actor weights and ships every step to the learner."""
+    global S, S_
+    random.seed(actor_id + 1)
+    np.random.seed(actor_id + 1)
+    tf.set_random_seed(actor_id + 1)
+    with tf.name_scope('S'):
+        S = tf.placeholder(tf.float32, shape=[None]+state_dim, name='s')
+    with tf.name_scope('S_'):
+        S_ = tf.placeholder(tf.float32, shape=[None]+state_dim, name='s_')
+
+    sess = tf.Session(config=config)
+    actor = Actor(sess, action_dim, FLAGS.LR_A, FLAGS.REPLACEMENT[0])
+    if FLAGS.single_graph:
+        classifier = FusedClassifier(sess, actor, [None, 224, 224, 3], FLAGS.num_classes, FLAGS.num_envs, state_dim)
+    sess.run(tf.global_variables_initializer())
+    if FLAGS.single_graph:
+        classifier.restore_model()
+    else:
+        classifier = Classifier([None, 224, 224, 3], FLAGS.num_classes, config)
+    sync_saver = tf.train.Saver(actor.e_params)
+    # daemonic actor processes cannot start worker processes, so they write on one thread
+    # pyplot is not thread-safe and only draws off the main thread with a non-interactive backend
+    plt.switch_backend('Agg')
+    writer = BackgroundWriter(save_raw_adversarial_example if FLAGS.raw_output else save_adversarial_example, 1, threads=True)
+
+    feature_store = None
+    pending_store = None
+    if FLAGS.feature_cache_dir:
+        feature_store = FeatureStore(FLAGS.feature_cache_dir, FLAGS.input_dir, checkpoint_fingerprint(FLAGS.checkpoint_path))
+        # only one process may create the cache files, the others join once they exist
+        if feature_store.valid is None and actor_id > 0:
+            pending_store, feature_store = feature_store, None
+
+    try:
+        while tf.train.latest_checkpoint(FLAGS.sync_dir) is None and not stop.is_set():
+            time.sleep(1)
+        synced = None
+        var = 0.01  # control exploration
+        while not stop.is_set():
+            data_generator = load_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3], store_dir=FLAGS.image_store_dir)
+            env = BatchEnv(classifier, data_generator, FLAGS.num_envs, feature_store)
+            step = 0
+            while env.active.any() and not stop.is_set():
+                if step % FLAGS.sync_every == 0:
+                    ckpt = tf.train.latest_checkpoint(FLAGS.sync_dir)
+                    if ckpt != synced:
+                        sync_saver.restore(sess, ckpt)
+                        synced = ckpt
+                    if pending_store is not None and pending_store.refresh():
+                        feature_store = env.feature_store = pending_store
+                        pending_store = None
+                slots, features = env.observe()
+                if FLAGS.single_graph:
+                    actions, r, l2_dist, pre_labels, features_, success, done = env.act(slots, var)
+                else:
+                    actions = actor.choose_action(features)
+                    actions = np.clip(np.random.normal(actions, var), -FLAGS.EPSILON, FLAGS.EPSILON)  # add randomness to action selection for exploration
+                    r, l2_dist, pre_labels, features_, success, done = env.step(slots, actions)
+                # the learner keeps the memory ids, here state_refs only marks the first step of an image
+                fresh = env.state_refs[slots] < 0
+                env.state_refs[slots] = 0
+                transitions.put(actor_id, slots, fresh, features, actions, r/10.0, features_)
+
+                for i in np.flatnonzero(success):
+                    k = slots[i]
+                    writer.submit(env.images[k].copy(), env.noise_images[k].copy(), env.true_labels[k], env.labels[k], pre_labels[i], l2_dist[i], env.filepaths[k])
+                    print('Actor:{}, Step {:06d}, cur_reward: {:.3f}, distance: {:.3f}, exploration: {:.3f}, true label/pre label: {}/{}'.format(actor_id, env.steps[k], r[i], l2_dist[i], var, env.labels[k], pre_labels[i]))
+
+                env.reset(slots[done])
+                with env_steps.get_lock():
+                    env_steps.value += len(slots)
+                step += 1
+            if feature_store is not None:
+                feature_store.flush()
+    finally:
+        # daemonic processes skip atexit, so the examples still queued are written here
+        writer.close()
+        # tells the learner this actor puts no more transitions
+        transitions.close()
+
+
+def run_learner(sess, agent, actor, M, ac_saver, transitions, env_steps):
+    """Stores the actors' transitions and trains on the replay memory until `max_steps`."""
+    sync_saver = AsyncSaver(actor.e_params, max_to_keep=3)
+    if not tf.gfile.Exists(FLAGS.sync_dir):
+        tf.gfile.MakeDirs(FLAGS.sync_dir)
+    sync_saver.save(sess, FLAGS.sync_dir + 'actor', global_step=0)
+    # memory id of the current state of every actor's env slots
+    state_refs = np.full([FLAGS.num_actors, FLAGS.num_envs], -1, dtype=np.int64)
+    critic_losses = []
+    last_env_steps = 0
+    exited = 0
+    start = time.time()
+    for step in range(1, FLAGS.max_steps + 1):
+        # wait for transitions until the memory is full, then take what has arrived
+        drained = 0
+        while len(M) < M.capacity or drained < FLAGS.num_actors:
+            try:
+                item = transitions.get(block=len(M) < M.capacity)
+            except queue.Empty:
+                break
+            if item is None:
+                # an actor stopped on an error
+                exited += 1
+                if exited == FLAGS.num_actors:
+                    raise RuntimeError('Every actor process has exited')
+                continue
+            slot, (actor_id, slots, fresh, features, actions, r, features_) = item
+            refs = M.store_batch(features, actions, r, features_, np.where(fresh, -1, state_refs[actor_id, slots]))
+            # the memory holds its own copy, the actors can refill the slot
+            transitions.release(slot)
+            if refs is not None:
+                state_refs[actor_id, slots] = refs
+            drained += 1
+
+        critic_losses.append(agent.learn(M, FLAGS.batch_size))
+
+        if step % FLAGS.sync_every == 0:
+            sync_saver.save(sess, FLAGS.sync_dir + 'actor', global_step=step)
+        if step % 100 == 0:
+            elapsed = time.time() - start
+            start = time.time()
+            print('Learner step {:06d}, {:.2f} learner steps/second, {:.2f} env steps/second, memory: {}, mean critic loss: {:.5f}'.format(
+                step, 100 / elapsed, (env_steps.value - last_env_steps) / elapsed, len(M), np.mean(critic_losses)))
+            last_env_steps = env_steps.value
+            critic_losses = []
+        if step % FLAGS.save_checkpoint_steps == 0:
+            ac_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=step)
+            M.flush()
+            if ac_saver.latencies:
+                print('Checkpoint snapshot: {:.3f} seconds, write: {:.3f} seconds'.format(*ac_saver.latencies[-1]))
+    sync_saver.close()
+    return exited
+
+def stop_actors(actor_processes, transitions, stop, exited=0, timeout=60):
+    """Stops the actors and drains their transitions until every one of them has flushed its writer."""
+    stop.set()
+    running = len(actor_processes) - exited
+    deadline = time.time() + timeout
+    # an actor waiting for a free slot never sees stop, and one with queued data cannot exit
+    while running and time.time() < deadline:
+        try:
+            item = transitions.get(timeout=1)
+        except queue.Empty:
+            continue
+        if item is None:
+            running -= 1
+        else:
+            transitions.release(item[0])
+    for p in actor_processes:
+        p.join(max(deadline - time.time(), 1))
+        if p.is_alive():
+            p.terminate()
 
 #####################  Main  ####################
 if __name__ == "__main__":
     state_dim = [7, 7, 1024]
     action_dim = [7, 7, 1024]
 
+    # the actors only read the image store, building it in each of them would race on the same files
+    if FLAGS.image_store_dir and not image_store_valid(FLAGS.input_dir, FLAGS.image_store_dir, [FLAGS.image_height, FLAGS.image_width]):
+        build_image_store(FLAGS.input_dir, FLAGS.image_store_dir, [FLAGS.image_height, FLAGS.image_width])
+
+    # actor processes have to be forked before this process builds any graph
+    if FLAGS.num_actors > 0:
+        # the learner and every actor open their own sessions on the same GPU
+        config.gpu_options.allow_growth = True
+        # the transitions go through shared memory, only slot indices are queued
+        transitions = TransitionSlots(4 * FLAGS.num_actors, FLAGS.num_envs, state_dim, [FLAGS.image_height, FLAGS.image_width, 3])
+        env_steps = multiprocessing.Value('l', 0)
+        stop = multiprocessing.Event()
+        actor_processes = [multiprocessing.Process(target=run_actor, args=(i, state_dim, action_dim, transitions, env_steps, stop))
+                           for i in range(FLAGS.num_actors)]
+        for p in actor_processes:
+            p.daemon = True
+            p.start()
+    else:
+        # like the actors, the writer processes are forked before any graph exists
+        writer = BackgroundWriter(save_raw_adversarial_example if FLAGS.raw_output else save_adversarial_example, FLAGS.num_writers)
+
     # all placeholder for tf
     with tf.name_scope('S'):
         S = tf.placeholder(tf.float32, shape=[None]+state_dim, name='s')
@@ -344,97 +787,99 @@ if __name__ == "__main__":
     # Create actor and critic
     actor = Actor(sess, action_dim, FLAGS.LR_A, FLAGS.REPLACEMENT[0])
     critic = Critic(sess, state_dim, action_dim, FLAGS.LR_C, FLAGS.GAMMA, FLAGS.REPLACEMENT[0], actor.a, actor.a_)
-    actor.add_grad_to_graph(critic.a_grads)
+    actor.add_grad_to_graph(critic.a_grads, [critic.train_op])
+    agent = DDPGAgent(sess, actor, critic, FLAGS.REPLACEMENT[0])
+
+    if FLAGS.single_graph and FLAGS.num_actors == 0:
+        classifier = FusedClassifier(sess, actor, [None, 224, 224, 3], FLAGS.num_classes, FLAGS.num_envs, state_dim)
 
     sess.run(tf.global_variables_initializer())
     ac_var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, 'Actor') + tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='Critic')
     ac_saver = tf.train.Saver(ac_var_list, max_to_keep=3)
+    # checkpoints are written on a background thread, ac_saver only restores
+    ac_async_saver = AsyncSaver(ac_var_list, max_to_keep=3)
     if not tf.gfile.Exists(FLAGS.ddpg_checkpoint_path):
         tf.gfile.MkDir(FLAGS.ddpg_checkpoint_path)
     else:
         if tf.train.latest_checkpoint(FLAGS.ddpg_checkpoint_path):
             ac_saver.restore(sess, tf.train.latest_checkpoint(FLAGS.ddpg_checkpoint_path))
 
-    # initialization classifier
-    classifier = Classifier([None, 224, 224, 3], FLAGS.num_classes)
+    if FLAGS.prioritized_replay:
+        M = PrioritizedMemory(FLAGS.MEMORY_CAPACITY, FLAGS.memory_storage, FLAGS.memory_dir, FLAGS.share_states)
+    else:
+        M = Memory(FLAGS.MEMORY_CAPACITY, FLAGS.memory_storage, FLAGS.memory_dir, FLAGS.share_states)
+    # a full memory from the previous run can be learned from right away
+    warm_start = len(M) == M.capacity
+    if len(M):
+        print('Restored {} transitions from {}'.format(len(M), FLAGS.memory_dir))
+
+    if FLAGS.num_actors > 0:
+        exited = run_learner(sess, agent, actor, M, ac_async_saver, transitions, env_steps)
+        M.flush()
+        stop_actors(actor_processes, transitions, stop, exited)
+    else:
+        # initialization classifier
+        if FLAGS.single_graph:
+            classifier.restore_model()
+        else:
+            classifier = Classifier([None, 224, 224, 3], FLAGS.num_classes, config)
     
-    M = Memory(FLAGS.MEMORY_CAPACITY)
-    var = 0.01  # control exploration
-    start = time.time()
+        # clean image features only depend on the frozen classifier, so compute them once
+        feature_store = None
+        if FLAGS.feature_cache_dir:
+            feature_store = FeatureStore(FLAGS.feature_cache_dir, FLAGS.input_dir, checkpoint_fingerprint(FLAGS.checkpoint_path))
+
+        var = 0.01  # control exploration
+        start = time.time()
     
-    for episode in range(FLAGS.max_ep_steps):
-        data_generator = load_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3])
-        image_cnt = 0
-        for images, true_labels, filepaths in data_generator:
-            image_cnt += 1
+        for episode in range(FLAGS.max_ep_steps):
+            data_generator = load_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3], store_dir=FLAGS.image_store_dir)
+            env = BatchEnv(classifier, data_generator, FLAGS.num_envs, feature_store)
             step = 0
-            done = False
-            features, labels, pred_val = classifier.extract_feature(images)
-            noise_images = images
-            while not done:
-                actions = actor.choose_action(features)
-                actions = np.clip(np.random.normal(actions, var), -FLAGS.EPSILON, FLAGS.EPSILON)  # add randomness to action selection for exploration
-
-                noise_images = np.clip(noise_images + actions, -1, 1)
-                r, l2_dist, pre_labels = classifier.get_reward(images, noise_images, labels, pred_val)
-
-                features_, _, _ = classifier.extract_feature(noise_images)
-
-                M.store_transition(features[0], actions[0], r/10.0, features_[0])
-                features = features_
-
-                if l2_dist > FLAGS.MAX_L2:
-                    break
-
-                if pre_labels[0] != labels[0]:
-                    ### save plot image ###
-                    f = plt.figure(figsize=(12,4))
-                    # original image
-                    f.add_subplot(1, 3, 1)
-                    plt.title('original image\ntrue label {}\npredicted label {}'.format(true_labels[0], labels[0]))
-                    plt.imshow((images[0] + 1.0) / 2.0)
-                    # cumulative noise
-                    cumulative_noise = (noise_images[0]-images[0]+ 1.0) / 2.0
-                    f.add_subplot(1, 3, 2)
-                    plt.title('noise\ndistance={:.3f}'.format(l2_dist))
-                    plt.ylabel('+',rotation=0, fontsize=20, labelpad=20)
-                    plt.imshow(cumulative_noise)
-                    # noise image
-                    f.add_subplot(1, 3, 3)
-                    plt.title('adversarial image\npredicted label {}'.format(pre_labels[0]))
-                    plt.imshow(np.clip((noise_images[0] + 1) / 2.0, 0, 1))
-                    plt.ylabel('=',rotation=0, fontsize=20, labelpad=20)
-                    plt.tight_layout()
-                    # plt.show(block=True)
-                    plt.savefig(FLAGS.output_plt_dir + filepaths[0].split('/')[-1].split('.')[0] + '.pdf', format='pdf')
-                    plt.close()
-                    ### save noise image for training ###
-                    fn = '{}/{:05d}/{}.jpg'.format(FLAGS.output_adv_dir, true_labels[0], filepaths[0].split('/')[-1].split('.')[0])
-                    with open(fn, 'w') as f:
-                        img = (((noise_images[0] + 1.0) * 0.5) * 255.0).astype(np.uint8)
-                        Image.fromarray(img).save(f, format='JPEG')
-                    done = True
-                    print('Episode:{}, Step {:06d}, cur_reward: {:.3f}, distance: {:.3f}, exploration: {:.3f}, true label/pre label: {}/{}'.format(episode, step, r, l2_dist, var, labels[0], pre_labels[0]))
-
-                if image_cnt > FLAGS.MEMORY_CAPACITY and step % 10 == 0:
-                    # var *= .9995    # decay the action randomness
-                    minibatch = M.sample(FLAGS.batch_size)   
-                    b_s = [row[0] for row in minibatch]
-                    b_a = [row[1] for row in minibatch]
-                    b_r = [row[2] for row in minibatch]
-                    b_s_ = [row[3] for row in minibatch]
-
-                    critic.learn(b_s, b_a, b_r, b_s_)
-                    actor.learn(b_s)
-
-                    # ep_reward += r
+            learn_credit = 0
+            critic_losses = []
+            while env.active.any():
+                slots, features = env.observe()
+                if FLAGS.single_graph:
+                    actions, r, l2_dist, pre_labels, features_, success, done = env.act(slots, var)
+                else:
+                    actions = actor.choose_action(features)
+                    actions = np.clip(np.random.normal(actions, var), -FLAGS.EPSILON, FLAGS.EPSILON)  # add randomness to action selection for exploration
+                    r, l2_dist, pre_labels, features_, success, done = env.step(slots, actions)
+                state_refs = M.store_batch(features, actions, r/10.0, features_, env.state_refs[slots])
+                if state_refs is not None:
+                    env.state_refs[slots] = state_refs
+
+                for i in np.flatnonzero(success):
+                    k = slots[i]
+                    writer.submit(env.images[k].copy(), env.noise_images[k].copy(), env.true_labels[k], env.labels[k], pre_labels[i], l2_dist[i], env.filepaths[k])
+                    print('Episode:{}, Step {:06d}, cur_reward: {:.3f}, distance: {:.3f}, exploration: {:.3f}, true label/pre label: {}/{}'.format(episode, env.steps[k], r[i], l2_dist[i], var, env.labels[k], pre_labels[i]))
+
+                if warm_start or env.image_cnt > FLAGS.MEMORY_CAPACITY:
+                    # keep about one learning step per 10 stored transitions
+                    learn_credit += len(slots)
+                    while learn_credit >= 10:
+                        # var *= .9995    # decay the action randomness
+                        critic_losses.append(agent.learn(M, FLAGS.batch_size))
+                        learn_credit -= 10
 
                 if step % 10 == 0:
                     avg_time_per_step = (time.time() - start)/10
                     start = time.time()
-                    print('Episode:{}, image count: {:06d}, Step {:06d}, {:.2f} seconds/step, cur_reward: {:.3f}, distance: {:.3f}, exploration: {:.3f}, true label/pre label: {}/{}'.format(episode, image_cnt, step, avg_time_per_step, r, l2_dist, var, labels[0], pre_labels[0]))
-                
+                    print('Episode:{}, image count: {:06d}, Step {:06d}, {:.2f} seconds/step, {} images/step, mean reward: {:.3f}, mean distance: {:.3f}, exploration: {:.3f}'.format(episode, env.image_cnt, step, avg_time_per_step, len(slots), r.mean(), l2_dist.mean(), var))
+
+                env.reset(slots[done])
                 step += 1
-        ac_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=episode)
+            ac_async_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=episode)
+            M.flush()
+            if feature_store is not None:
+                feature_store.flush()
+            error = M.reconstruction_error()
+            print('Episode:{}, memory: {} x {} transitions, {:.1f} MB, state rmse: {:.5f}, action rmse: {:.5f}, mean critic loss: {:.5f}'.format(
+                episode, FLAGS.memory_storage, len(M), M.nbytes / 2.0**20, error['states'], error['actions'], np.mean(critic_losses) if critic_losses else float('nan')))
         
-        print('Running time: ', time.time() - start)
\ No newline at end of file
+            print('Running time: ', time.time() - start)
+            if ac_async_saver.latencies:
+                print('Checkpoint snapshot: {:.3f} seconds, write: {:.3f} seconds'.format(*ac_async_saver.latencies[-1]))
+        writer.close()
+    ac_async_saver.close()
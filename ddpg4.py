@@ -4,11 +4,11 @@ import numpy as np
 from scipy.misc import imread
 from scipy.misc import imresize
 import matplotlib.pyplot as plt
-from collections import deque
-import random
 from tensorflow.contrib.slim.nets import inception
 import time
-from mytools import load_path_label
+from mytools import cycle_path_label
+from replay_memory import Memory
+from async_saver import AsyncSaver
 
 
 np.random.seed(1)
@@ -33,6 +33,7 @@ tf.flags.DEFINE_string('output_file', './output-defense.txt', 'Output file to sa
 tf.flags.DEFINE_integer('image_width', 224, 'Width of each input images.')
 tf.flags.DEFINE_integer('image_height', 224, 'Height of each input images.')
 tf.flags.DEFINE_integer('batch_size', 32, 'Batch size to processing images')
+tf.flags.DEFINE_integer('num_envs', 8, 'The number of images attacked in lockstep')
 tf.flags.DEFINE_integer('nb_pixel', 224*224*3, 'The number of pixelx in a image')
 tf.flags.DEFINE_integer('num_classes', 110, 'How many classes of the data set')
 tf.app.flags.DEFINE_integer('max_ep_steps', 10000, 'The number of epoch times')
@@ -267,20 +268,6 @@ class Critic(object):
                 self.sess.run(self.hard_replacement)
             self.t_replace_counter += 1
 
-#####################  Memory  ####################
-class Memory(object):
-    def __init__(self, capacity):
-        self.capacity = capacity
-        self.data = deque()
-
-    def store_transition(self, s, a, r, s_):
-        self.data.append((s, a, r, s_))
-        if len(self.data) > self.capacity:
-            self.data.popleft()
-
-    def sample(self, n):
-        return random.sample(self.data, n)
-
 #####################  Prediction Model ####################
 class Classifier(object):
     def __init__(self, input_shape, nb_classes):
@@ -310,16 +297,67 @@ class Classifier(object):
             self.sess = tf.train.MonitoredSession(session_creator=session_creator)
 
     def get_reward(self, images, noise_images, labels):
-        l2_dist = np.linalg.norm(images - noise_images)
-
         pre_labels, predictions = self.sess.run([self.pre_labels, self.predictions], feed_dict={self.x_input: noise_images})
-        
-        r = np.square(1 - predictions[0][labels[0]])
+        return self.compute_reward(images, noise_images, labels, pre_labels, predictions)
+
+    def compute_reward(self, images, noise_images, labels, pre_labels, predictions):
+        # per-sample reward, L2 distance and predicted label for the whole batch
+        batch_size = len(images)
+        l2_dist = np.linalg.norm((images - noise_images).reshape(batch_size, -1), axis=1)
+
+        r = np.square(1 - predictions[np.arange(batch_size), labels])
         return r, l2_dist, pre_labels
+
+    def step(self, images, noise_images, labels):
+        # one forward pass gives both the reward and the next state
+        features, pre_labels, predictions = self.sess.run([self.features, self.pre_labels, self.predictions], feed_dict={self.x_input: noise_images})
+        r, l2_dist, pre_labels = self.compute_reward(images, noise_images, labels, pre_labels, predictions)
+        return r, l2_dist, pre_labels, features
     
     def extract_feature(self, images):
         return self.sess.run([self.features, self.pre_labels], feed_dict={self.x_input: images})
 
+#####################  Environment  ####################
+class BatchEnv(object):
+    """Runs `num_envs` attack episodes in lockstep.
+
+    Every slot holds one image, its accumulated perturbation and the
+    features of the perturbed image. Slots whose episode is done are
+    refilled from `data_generator` by `reset`, so the actor and the
+    classifier always work on a full batch.
+    """
+    def __init__(self, classifier, data_generator, num_envs):
+        self.classifier = classifier
+        self.data_generator = data_generator
+        self.num_envs = num_envs
+        self.steps = np.zeros(num_envs, dtype=np.int64)
+        self.labels = np.zeros(num_envs, dtype=np.int64)
+        self.filepaths = [None] * num_envs
+        self.images = None
+        self.noise_images = None
+        self.features = None
+        self.reset(np.arange(num_envs))
+
+    def reset(self, slots):
+        """Loads the next image into each of `slots`."""
+        if len(slots) == 0:
+            return
+        images, _, filepaths = zip(*[next(self.data_generator) for _ in slots])
+        images = np.concatenate(images).astype(np.float32)
+        # the attack targets the label the classifier predicts for the clean image
+        features, labels = self.classifier.extract_feature(images)
+        if self.images is None:
+            self.images = np.zeros((self.num_envs,) + images.shape[1:], dtype=np.float32)
+            self.noise_images = np.zeros_like(self.images)
+            self.features = np.zeros((self.num_envs,) + features.shape[1:], dtype=np.float32)
+        self.images[slots] = images
+        self.noise_images[slots] = images
+        self.features[slots] = features
+        self.labels[slots] = labels
+        self.steps[slots] = 0
+        for i, x in zip(slots, filepaths):
+            self.filepaths[i] = x[0]
+
 #####################  Main  ####################
 if __name__ == "__main__":
     state_dim = [7, 7, 1024]
@@ -342,6 +380,8 @@ if __name__ == "__main__":
     sess.run(tf.global_variables_initializer())
     ac_var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, 'Actor') + tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='Critic')
     ac_saver = tf.train.Saver(ac_var_list, max_to_keep=3)
+    # checkpoints are written on a background thread, ac_saver only restores
+    ac_async_saver = AsyncSaver(ac_var_list, max_to_keep=3)
     if not tf.gfile.Exists(FLAGS.ddpg_checkpoint_path):
         tf.gfile.MkDir(FLAGS.ddpg_checkpoint_path)
     else:
@@ -354,60 +394,56 @@ if __name__ == "__main__":
     M = Memory(FLAGS.MEMORY_CAPACITY)
     var = 0.001  # control exploration
     start = time.time()
-    data_generator = load_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3])
-    for episode in range(FLAGS.max_ep_steps):
-        # ep_reward = 0.0
-        step = 0
-        done = False
-        (images, _, filepaths) = next(data_generator)
-        features, labels = classifier.extract_feature(images)
-        noise_images = images
-        while not done:
-            actions = actor.choose_action(features)
-            actions = np.clip(np.random.normal(actions, var), -FLAGS.EPSILON, FLAGS.EPSILON)  # add randomness to action selection for exploration
-            noise_images = np.clip(noise_images + actions, -1, 1)
-            r, l2_dist, pre_labels = classifier.get_reward(images, noise_images, labels)
-
-            features_, _ = classifier.extract_feature(noise_images)
-            M.store_transition(features[0], actions[0], r/10, features_[0])
-            features = features_
-
-            if pre_labels[0] != labels[0]:
-                f = plt.figure()
-                f.add_subplot(1, 2, 1)
-                plt.title('Ture label {}'.format(labels[0]))
-                plt.imshow((images[0] + 1.0) / 2.0)
-                f.add_subplot(1, 2, 2)
-                plt.title('Predction label {}'.format(pre_labels[0]))
-                plt.imshow(np.clip((noise_images[0] + 1) / 2.0, 0, 1))
-                # plt.show(block=True)
-                plt.savefig(FLAGS.output_dir + filepaths[0].split('/')[-1].split('.')[0] + '.png')
-                plt.clf()
-                done = True
-                print('Episode:{}, Step {:06d}, cur_reward: {:.3f}, distance: {:.3f}, exploration: {:.3f}, true label/pre label: {}/{}'.format(
-                    episode, step, r, l2_dist, var, labels[0], pre_labels[0]))
-
-            if step > FLAGS.MEMORY_CAPACITY/100:
-                var *= .9995    # decay the action randomness
-                minibatch = M.sample(FLAGS.batch_size)
-                b_s = [row[0] for row in minibatch]
-                b_a = [row[1] for row in minibatch]
-                b_r = [row[2] for row in minibatch]
-                b_s_ = [row[3] for row in minibatch]
-
-                critic.learn(b_s, b_a, b_r, b_s_)
-                actor.learn(b_s)
-
-                # ep_reward += r
-
-            if step % 10 == 0:
-                avg_time_per_step = (time.time() - start)/10
-                start = time.time()
-                print('Episode:{}, Step {:06d}, {:.2f} seconds/step, cur_reward: {:.3f}, distance: {:.3f}, exploration: {:.3f}, true label/pre label: {}/{}'.format(
-                    episode, step, avg_time_per_step, r, l2_dist, var, labels[0], pre_labels[0]))
-            
-            step += 1
-        if episode % 10 == 9:
-            ac_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=episode)
-        
-        print('Running time: ', time.time() - start)
\ No newline at end of file
+    env = BatchEnv(classifier, cycle_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3]), FLAGS.num_envs)
+    episode = 0
+    step = 0
+    while episode < FLAGS.max_ep_steps:
+        actions = actor.choose_action(env.features)
+        actions = np.clip(np.random.normal(actions, var), -FLAGS.EPSILON, FLAGS.EPSILON)  # add randomness to action selection for exploration
+        env.noise_images = np.clip(env.noise_images + actions, -1, 1)
+        r, l2_dist, pre_labels, features_ = classifier.step(env.images, env.noise_images, env.labels)
+        M.store_batch(env.features, actions, r/10, features_)
+        env.features = features_
+
+        done = pre_labels != env.labels
+        for i in np.flatnonzero(done):
+            f = plt.figure()
+            f.add_subplot(1, 2, 1)
+            plt.title('Ture label {}'.format(env.labels[i]))
+            plt.imshow((env.images[i] + 1.0) / 2.0)
+            f.add_subplot(1, 2, 2)
+            plt.title('Predction label {}'.format(pre_labels[i]))
+            plt.imshow(np.clip((env.noise_images[i] + 1) / 2.0, 0, 1))
+            # plt.show(block=True)
+            plt.savefig(FLAGS.output_dir + env.filepaths[i].split('/')[-1].split('.')[0] + '.png')
+            plt.clf()
+            print('Episode:{}, Step {:06d}, cur_reward: {:.3f}, distance: {:.3f}, exploration: {:.3f}, true label/pre label: {}/{}'.format(
+                episode, env.steps[i], r[i], l2_dist[i], var, env.labels[i], pre_labels[i]))
+
+        # one learning step per transition of an episode past its first MEMORY_CAPACITY/100 steps
+        for _ in range(np.sum(env.steps > FLAGS.MEMORY_CAPACITY/100)):
+            var *= .9995    # decay the action randomness
+            b_s, b_a, b_r, b_s_ = M.sample(FLAGS.batch_size)
+
+            critic.learn(b_s, b_a, b_r, b_s_)
+            actor.learn(b_s)
+
+            # ep_reward += r
+
+        if step % 10 == 0:
+            avg_time_per_step = (time.time() - start)/10
+            start = time.time()
+            print('Episode:{}, Step {:06d}, {:.2f} seconds/step, mean reward: {:.3f}, mean distance: {:.3f}, exploration: {:.3f}'.format(
+                episode, step, avg_time_per_step, r.mean(), l2_dist.mean(), var))
+
+        env.steps += 1
+        step += 1
+        if done.any():
+            finished = episode
+            episode += done.sum()
+            env.reset(np.flatnonzero(done))
+            if episode // 10 > finished // 10:
+                ac_async_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=episode)
+                if ac_async_saver.latencies:
+                    print('Checkpoint snapshot: {:.3f} seconds, write: {:.3f} seconds'.format(*ac_async_saver.latencies[-1]))
+    ac_async_saver.close()
@@ -4,11 +4,11 @@ import numpy as np
 from scipy.misc import imread
 from scipy.misc import imresize
 import matplotlib.pyplot as plt
-from collections import deque
-import random
 from tensorflow.contrib.slim.nets import inception
 import time
-from mytools import load_path_label
+from mytools import cycle_path_label
+from replay_memory import Memory
+from async_saver import AsyncSaver
 
 
 # np.random.seed(1)
@@ -43,6 +43,10 @@ tf.flags.DEFINE_integer(
     'image_height', 224, 'Height of each input images.')
 tf.flags.DEFINE_integer(
     'batch_size', 32, 'Batch size to processing images')
+tf.flags.DEFINE_integer(
+    'num_envs', 8, 'The number of images attacked in lockstep')
+tf.flags.DEFINE_string(
+    'memory_storage', 'float32', 'How the replay memory keeps states and actions: float32, float16 or int8')
 tf.flags.DEFINE_integer(
     'nb_pixel', 224*224*3, 'The number of pixelx in a image')
 tf.flags.DEFINE_integer(
@@ -283,20 +287,6 @@ class Critic(object):
                 self.sess.run(self.hard_replacement)
             self.t_replace_counter += 1
 
-#####################  Memory  ####################
-class Memory(object):
-    def __init__(self, capacity):
-        self.capacity = capacity
-        self.data = deque()
-
-    def store_transition(self, s, a, r, s_):
-        self.data.append((s, a, r, s_))
-        if len(self.data) > self.capacity:
-            self.data.popleft()
-
-    def sample(self, n):
-        return random.sample(self.data, n)
-
 #####################  Load Image  ####################
 def load_images(input_dir):
     for filepath in tf.gfile.Glob(os.path.join(input_dir, '*.jpg')):
@@ -336,26 +326,77 @@ class Classifier(object):
             self.sess = tf.train.MonitoredSession(session_creator=session_creator)
 
     def get_reward(self, images, noise_images, labels):
-        l2_dist = np.linalg.norm(images - noise_images) * 255.0 / 2.0
-        max_norm = 3000.0
-        is_equal = False
-
         pre_labels = self.sess.run(self.pre_labels, feed_dict={self.x_input: noise_images})
+        return self.compute_reward(images, noise_images, labels, pre_labels)
 
-        if l2_dist > max_norm:
-                r = -1.0
-        else:
-            if pre_labels[0] == labels[0]:
-                r = 0.01
-                is_equal = True
-            else:
-                r = 1.0
-                print('true label: {}, predict label: {}'.format(labels[0]), pre_labels[0])
-        return r, l2_dist, is_equal
+    def compute_reward(self, images, noise_images, labels, pre_labels):
+        # per-sample reward, L2 distance and predicted label for the whole batch
+        batch_size = len(images)
+        l2_dist = np.linalg.norm((images - noise_images).reshape(batch_size, -1), axis=1) * 255.0 / 2.0
+        max_norm = 3000.0
+
+        r = np.where(pre_labels == labels, 0.01, 1.0)
+        r = np.where(l2_dist > max_norm, -1.0, r)
+        for i in np.flatnonzero(r == 1.0):
+            print('true label: {}, predict label: {}'.format(labels[i], pre_labels[i]))
+        return r, l2_dist, pre_labels
+
+    def step(self, images, noise_images, labels):
+        # one forward pass gives both the reward and the next state
+        features, pre_labels = self.sess.run([self.features, self.pre_labels], feed_dict={self.x_input: noise_images})
+        r, l2_dist, pre_labels = self.compute_reward(images, noise_images, labels, pre_labels)
+        return r, l2_dist, pre_labels, features
     
     def extract_feature(self, images):
         return self.sess.run(self.features, feed_dict={self.x_input: images})
 
+#####################  Environment  ####################
+class BatchEnv(object):
+    """Runs `num_envs` attack episodes in lockstep.
+
+    Every slot holds one image, its accumulated perturbation and the
+    features of the perturbed image. Slots whose episode is done are
+    refilled from `data_generator` by `reset`, so the actor and the
+    classifier always work on a full batch.
+    """
+    def __init__(self, classifier, data_generator, num_envs):
+        self.classifier = classifier
+        self.data_generator = data_generator
+        self.num_envs = num_envs
+        self.steps = np.zeros(num_envs, dtype=np.int64)
+        self.labels = np.zeros(num_envs, dtype=np.int64)
+        self.filepaths = [None] * num_envs
+        self.images = None
+        self.noise_images = None
+        self.features = None
+        self.reset(np.arange(num_envs))
+
+    def reset(self, slots):
+        """Loads the next image into each of `slots`."""
+        if len(slots) == 0:
+            return
+        images, labels, filepaths = zip(*[next(self.data_generator) for _ in slots])
+        images = np.concatenate(images).astype(np.float32)
+        if self.images is None:
+            self.images = np.zeros((self.num_envs,) + images.shape[1:], dtype=np.float32)
+            self.noise_images = np.zeros_like(self.images)
+        self.images[slots] = images
+        self.labels[slots] = [x[0] for x in labels]
+        self.steps[slots] = 0
+        for i, x in zip(slots, filepaths):
+            self.filepaths[i] = x[0]
+        self.restart(slots)
+
+    def restart(self, slots):
+        """Drops the perturbation of `slots` and starts over from their clean images."""
+        if len(slots) == 0:
+            return
+        self.noise_images[slots] = self.images[slots]
+        features = self.classifier.extract_feature(self.images[slots])
+        if self.features is None:
+            self.features = np.zeros((self.num_envs,) + features.shape[1:], dtype=np.float32)
+        self.features[slots] = features
+
 #####################  Main  ####################
 if __name__ == "__main__":
     state_dim = [7, 7, 1024]
@@ -378,6 +419,8 @@ if __name__ == "__main__":
     sess.run(tf.global_variables_initializer())
     ac_var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, 'Actor') + tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='Critic')
     ac_saver = tf.train.Saver(ac_var_list, max_to_keep=3)
+    # checkpoints are written on a background thread, ac_saver only restores
+    ac_async_saver = AsyncSaver(ac_var_list, max_to_keep=3)
     if not tf.gfile.Exists(FLAGS.ddpg_checkpoint_path):
         tf.gfile.MkDir(FLAGS.ddpg_checkpoint_path)
     else:
@@ -387,64 +430,63 @@ if __name__ == "__main__":
     # initialization classifier
     classifier = Classifier([None, 224, 224, 3], FLAGS.num_classes)
     
-    M = Memory(MEMORY_CAPACITY)
+    M = Memory(MEMORY_CAPACITY, FLAGS.memory_storage)
     var = 0.0  # control exploration
     start = time.time()
-    data_generator = load_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3])
-    for episode in range(FLAGS.max_ep_steps):
-        # ep_reward = 0.0
-        step = 0
-        done = False
-        (images, labels, filepaths) = next(data_generator)
-        noise_images = images
-        features = classifier.extract_feature(noise_images)
-        while not done:
-            actions = actor.choose_action(features)
-            actions = np.clip(np.random.normal(actions, var), -1, 1)/1000  # add randomness to action selection for exploration
-            noise_images = np.clip(noise_images + actions, -1, 1)
-            r, l2_dist, is_equal = classifier.get_reward(images, noise_images, labels)
-            features_ = classifier.extract_feature(noise_images)
-            M.store_transition(features[0], actions[0], r, features_[0])
-
-            features = features_
-            if r > 0.1:
-                f = plt.figure()
-                f.add_subplot(1, 2, 1)
-                plt.imshow((images[0] + 1.0) / 2.0)
-                f.add_subplot(1, 2, 2)
-                plt.imshow(np.clip((images[0] + actions[0] + 1) / 2.0, 0, 1))
-                # plt.show(block=True)
-                plt.savefig(FLAGS.output_dir + filepaths[0].split('/')[-1].split('.')[0] + '.png')
-                plt.clf()
-                done = True
-            elif r < 0.0:
-                noise_images = images
-                features = classifier.extract_feature(noise_images)
-                print('Episode:{}, Step {:06d}, cur_reward: {:.3f}, distance: {:.3f}, equal: {}, exploration: {:.3f}'.format(
-                    episode, step, r, l2_dist, is_equal, var))
-
-            if step > MEMORY_CAPACITY / 2:
-                # var *= .9997    # decay the action randomness
-                minibatch = M.sample(FLAGS.batch_size)
-                b_s = [row[0] for row in minibatch]
-                b_a = [row[1] for row in minibatch]
-                b_r = [row[2] for row in minibatch]
-                b_s_ = [row[3] for row in minibatch]
-
-                critic.learn(b_s, b_a, b_r, b_s_)
-                actor.learn(b_s)
-
-                # ep_reward += r
-
-            if step % 10 == 0:
-                avg_time_per_step = (time.time() - start)/10
-                avg_examples_per_second = (10 * FLAGS.batch_size) /(time.time() - start)
-                start = time.time()
-                print('Episode:{}, Step {:06d}, {:.2f} seconds/step, {:.2f} examples/second, cur_reward: {:.3f}, distance: {:.3f}, equal: {}, exploration: {:.3f}'.format(
-                    episode, step, avg_time_per_step,
-                    avg_examples_per_second, r, l2_dist, is_equal, var))
+    env = BatchEnv(classifier, cycle_path_label(FLAGS.input_dir, [1, FLAGS.image_height, FLAGS.image_width, 3]), FLAGS.num_envs)
+    episode = 0
+    step = 0
+    while episode < FLAGS.max_ep_steps:
+        actions = actor.choose_action(env.features)
+        actions = np.clip(np.random.normal(actions, var), -1, 1)/1000  # add randomness to action selection for exploration
+        env.noise_images = np.clip(env.noise_images + actions, -1, 1)
+        r, l2_dist, pre_labels, features_ = classifier.step(env.images, env.noise_images, env.labels)
+        is_equal = (r > 0.0) & (pre_labels == env.labels)
+        M.store_batch(env.features, actions, r, features_)
+
+        env.features = features_
+        done = r > 0.1
+        for i in np.flatnonzero(done):
+            f = plt.figure()
+            f.add_subplot(1, 2, 1)
+            plt.imshow((env.images[i] + 1.0) / 2.0)
+            f.add_subplot(1, 2, 2)
+            plt.imshow(np.clip((env.images[i] + actions[i] + 1) / 2.0, 0, 1))
+            # plt.show(block=True)
+            plt.savefig(FLAGS.output_dir + env.filepaths[i].split('/')[-1].split('.')[0] + '.png')
+            plt.clf()
+        failed = np.flatnonzero(r < 0.0)
+        env.restart(failed)
+        for i in failed:
+            print('Episode:{}, Step {:06d}, cur_reward: {:.3f}, distance: {:.3f}, equal: {}, exploration: {:.3f}'.format(
+                episode, env.steps[i], r[i], l2_dist[i], is_equal[i], var))
+
+        # one learning step per transition of an episode past its first MEMORY_CAPACITY/2 steps
+        for _ in range(np.sum(env.steps > MEMORY_CAPACITY / 2)):
+            # var *= .9997    # decay the action randomness
+            b_s, b_a, b_r, b_s_ = M.sample(FLAGS.batch_size)
+
+            critic.learn(b_s, b_a, b_r, b_s_)
+            actor.learn(b_s)
+
+            # ep_reward += r
+
+        if step % 10 == 0:
+            avg_time_per_step = (time.time() - start)/10
+            avg_examples_per_second = (10 * FLAGS.num_envs) /(time.time() - start)
+            start = time.time()
+            print('Episode:{}, Step {:06d}, {:.2f} seconds/step, {:.2f} examples/second, mean reward: {:.3f}, mean distance: {:.3f}, equal: {}/{}, exploration: {:.3f}'.format(
+                episode, step, avg_time_per_step,
+                avg_examples_per_second, r.mean(), l2_dist.mean(), is_equal.sum(), FLAGS.num_envs, var))
             
-            step += 1
-        ac_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=episode)
+        env.steps += 1
+        step += 1
+        if done.any():
+            episode += done.sum()
+            env.reset(np.flatnonzero(done))
+            ac_async_saver.save(sess, FLAGS.ddpg_checkpoint_path + "model", global_step=episode)
+            if ac_async_saver.latencies:
+                print('Checkpoint snapshot: {:.3f} seconds, write: {:.3f} seconds'.format(*ac_async_saver.latencies[-1]))
         
-        print('Running time: ', time.time() - start)
\ No newline at end of file
+            print('Running time: ', time.time() - start)
+    ac_async_saver.close()
@@ -7,12 +7,22 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import sys
+import json
+import time
+import threading
 import numpy as np
 from scipy.misc import imread
 from scipy.misc import imresize
 import tensorflow as tf
 from tensorflow.contrib.slim.nets import inception
 slim = tf.contrib.slim
+try:
+    import queue
+    import socketserver
+except ImportError:
+    import Queue as queue
+    import SocketServer as socketserver
 
 tf.flags.DEFINE_string(
     'checkpoint_path', '', 'Path to checkpoint for inception network.')
@@ -28,28 +38,144 @@ tf.flags.DEFINE_integer(
     'batch_size', 16, 'Batch size to processing images')
 tf.flags.DEFINE_integer(
     'num_classes', 110, 'How many classes of the data set')
+tf.flags.DEFINE_string(
+    'serve', '', 'Keep the model loaded and serve JSON line requests, "stdin" to read stdin, otherwise the path of a unix socket')
+tf.flags.DEFINE_integer(
+    'max_wait_ms', 10, 'How long a served batch waits for more images before it runs')
 FLAGS = tf.flags.FLAGS
 
+def load_image(filepath):
+    with open(filepath, 'rb') as f:
+        raw_image = imread(f, mode='RGB')
+        image = imresize(raw_image, [FLAGS.image_height, FLAGS.image_width]).astype(np.float)
+        image = (image / 255.0) * 2.0 - 1.0
+    return image
+
+
 def load_images(input_dir, batch_shape):
-    images = np.zeros(batch_shape)
+    # one float32 buffer for all batches, every batch is consumed before the next is read
+    images = np.zeros(batch_shape, dtype=np.float32)
     filenames = []
     idx = 0
     batch_size = batch_shape[0]
     for filepath in tf.gfile.Glob(os.path.join(input_dir, '*.png')):
-        with open(filepath, 'rb') as f:
-            raw_image = imread(f, mode='RGB')
-            image = imresize(raw_image, [FLAGS.image_height, FLAGS.image_width]).astype(np.float)
-            image = (image / 255.0) * 2.0 - 1.0
-        images[idx, :, :, :] = image
+        images[idx, :, :, :] = load_image(filepath)
         filenames.append(os.path.basename(filepath))
         idx += 1
         if idx == batch_size:
             yield filenames, images
             filenames = []
-            images = np.zeros(batch_shape)
             idx = 0
     if idx > 0:
-        yield filenames, images
+        yield filenames, images[:idx]
+
+
+class MicroBatcher(object):
+    """Classifies the images of concurrent requests in shared batches.
+
+    A worker thread takes images from a bounded queue until it has a full
+    batch or `max_wait` seconds have passed since the first one, runs the
+    batch and hands every label back to the result queue of its request.
+    """
+    def __init__(self, sess, x_input, predicted_labels, batch_shape, max_wait):
+        self.sess = sess
+        self.x_input = x_input
+        self.predicted_labels = predicted_labels
+        self.batch = np.zeros(batch_shape, dtype=np.float32)
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=4 * batch_shape[0])
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def classify(self, images):
+        """Returns the labels of `images`, which may be a generator decoding them one by one."""
+        results = queue.Queue()
+        n = 0
+        for image in images:
+            self.queue.put((image, n, results))
+            n += 1
+        labels = np.zeros(n, dtype=np.int64)
+        for _ in range(n):
+            i, label = results.get()
+            if isinstance(label, Exception):
+                raise label
+            labels[i] = label
+        return labels
+
+    def _run(self):
+        batch_size = len(self.batch)
+        while True:
+            items = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(items) < batch_size:
+                try:
+                    items.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            for j, (image, _, _) in enumerate(items):
+                self.batch[j] = image
+            try:
+                labels = self.sess.run(self.predicted_labels, feed_dict={self.x_input: self.batch[:len(items)]})
+            except Exception as e:
+                labels = [e] * len(items)
+            for (_, i, results), label in zip(items, labels):
+                results.put((i, label))
+
+
+def handle_request(batcher, line):
+    """Classifies the images of one JSON request, given as `input_dir` or `paths`."""
+    response = {}
+    try:
+        request = json.loads(line)
+        response['id'] = request.get('id')
+        if 'input_dir' in request:
+            filepaths = tf.gfile.Glob(os.path.join(request['input_dir'], '*.png'))
+        else:
+            filepaths = request['paths']
+        labels = batcher.classify(load_image(filepath) for filepath in filepaths)
+        filenames = [os.path.basename(filepath) for filepath in filepaths]
+        if request.get('output_file'):
+            with open(request['output_file'], 'w') as out_file:
+                for filename, label in zip(filenames, labels):
+                    out_file.write('{0},{1}\n'.format(filename, label))
+        response['labels'] = [[filename, int(label)] for filename, label in zip(filenames, labels)]
+    except Exception as e:
+        response['error'] = str(e)
+    return json.dumps(response)
+
+
+def serve_stdin(batcher):
+    # one thread per request, so that requests still in flight share batches
+    lock = threading.Lock()
+    def _handle(line):
+        response = handle_request(batcher, line)
+        with lock:
+            sys.stdout.write(response + '\n')
+            sys.stdout.flush()
+    threads = []
+    for line in iter(sys.stdin.readline, ''):
+        if line.strip():
+            thread = threading.Thread(target=_handle, args=(line,))
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def serve_socket(batcher, path):
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in iter(self.rfile.readline, b''):
+                if line.strip():
+                    response = handle_request(batcher, line.decode('utf-8'))
+                    self.wfile.write((response + '\n').encode('utf-8'))
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, RequestHandler)
+    server.daemon_threads = True
+    tf.logging.info('Serving on %s', path)
+    server.serve_forever()
 
 
 def main(_):
@@ -60,7 +186,7 @@ def main(_):
 
     with tf.Graph().as_default():
         # Prepare graph
-        x_input = tf.placeholder(tf.float32, shape=batch_shape)
+        x_input = tf.placeholder(tf.float32, shape=[None] + batch_shape[1:])
 
         with slim.arg_scope(inception.inception_v1_arg_scope()):
             _, end_points = inception.inception_v1(
@@ -75,6 +201,13 @@ def main(_):
         
         # Run computation
         with tf.train.MonitoredSession(session_creator=session_creator) as sess:
+            if FLAGS.serve:
+                batcher = MicroBatcher(sess, x_input, predicted_labels, batch_shape, FLAGS.max_wait_ms / 1000.0)
+                if FLAGS.serve == 'stdin':
+                    serve_stdin(batcher)
+                else:
+                    serve_socket(batcher, FLAGS.serve)
+                return
             with open(FLAGS.output_file, 'w') as out_file:
                 for filenames, images in load_images(FLAGS.input_dir, batch_shape):
                     labels = sess.run(predicted_labels, feed_dict={x_input: images})
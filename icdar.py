@@ -2,7 +2,6 @@
 import glob
 import csv
 import cv2
-import time
 import os
 import numpy as np
 import scipy.optimize
@@ -248,6 +247,15 @@ def point_dist_to_line(p1, p2, p3):
     return np.linalg.norm(np.cross(p2 - p1, p1 - p3)) / np.linalg.norm(p2 - p1)
 
 
+def points_dist_to_line(p1, p2, points):
+    # vectorized point_dist_to_line for an [N, 2] array of points,
+    # evaluated with the same float32 operations as the scalar version
+    edge = p2 - p1
+    diff = p1 - points
+    cross = edge[0] * diff[:, 1] - edge[1] * diff[:, 0]
+    return np.sqrt(cross * cross) / np.linalg.norm(edge)
+
+
 def fit_line(p1, p2):
     # fit a line ax+by+c = 0
     if p1[0] == p1[1]:
@@ -565,18 +573,18 @@ def generate_rbox(im_size, polys, tags):
         rectange, rotate_angle = sort_rectangle(rectange)
 
         p0_rect, p1_rect, p2_rect, p3_rect = rectange
-        for y, x in xy_in_poly:
-            point = np.array([x, y], dtype=np.float32)
-            # top
-            geo_map[y, x, 0] = point_dist_to_line(p0_rect, p1_rect, point)
-            # right
-            geo_map[y, x, 1] = point_dist_to_line(p1_rect, p2_rect, point)
-            # down
-            geo_map[y, x, 2] = point_dist_to_line(p2_rect, p3_rect, point)
-            # left
-            geo_map[y, x, 3] = point_dist_to_line(p3_rect, p0_rect, point)
-            # angle
-            geo_map[y, x, 4] = rotate_angle
+        ys, xs = xy_in_poly[:, 0], xy_in_poly[:, 1]
+        points = xy_in_poly[:, ::-1].astype(np.float32)
+        # top
+        geo_map[ys, xs, 0] = points_dist_to_line(p0_rect, p1_rect, points)
+        # right
+        geo_map[ys, xs, 1] = points_dist_to_line(p1_rect, p2_rect, points)
+        # down
+        geo_map[ys, xs, 2] = points_dist_to_line(p2_rect, p3_rect, points)
+        # left
+        geo_map[ys, xs, 3] = points_dist_to_line(p3_rect, p0_rect, points)
+        # angle
+        geo_map[ys, xs, 4] = rotate_angle
     return score_map, geo_map, training_mask
 
 
@@ -720,20 +728,13 @@ def generator(input_size=512, batch_size=32,
 
 
 def get_batch(num_workers, **kwargs):
+    enqueuer = None
     try:
         enqueuer = GeneratorEnqueuer(generator(**kwargs), use_multiprocessing=True)
         print('Generator use 10 batches for buffering, this may take a while, you can tune this yourself.')
         enqueuer.start(max_queue_size=10, workers=num_workers)
-        generator_output = None
-        while True:
-            while enqueuer.is_running():
-                if not enqueuer.queue.empty():
-                    generator_output = enqueuer.queue.get()
-                    break
-                else:
-                    time.sleep(0.01)
+        for generator_output in enqueuer.get():
             yield generator_output
-            generator_output = None
     finally:
         if enqueuer is not None:
             enqueuer.stop()
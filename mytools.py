@@ -1,6 +1,13 @@
 import os
+import glob
+import atexit
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import random
+from collections import deque
 from scipy.misc import imread, imresize
 from PIL import Image
 
@@ -16,7 +23,200 @@ def preprocessor(im):
     image = ( image / 255.0 ) * 2.0 - 1.0
     return image
     
-def load_path_label(fname=None, batch_shape=None, separator='\t', shuffle=True, onehot=False):
+def image_store_key(fname, image_size):
+    """Hash of the label file and image size a store is built from."""
+    with open(fname, 'rb') as f:
+        content = f.read()
+    return hashlib.sha1(content + '{}x{}'.format(*image_size).encode('utf-8')).hexdigest()
+
+def image_store_valid(fname, store_dir, image_size):
+    if not os.path.exists(os.path.join(store_dir, 'images.npy')):
+        return False
+    try:
+        with open(os.path.join(store_dir, 'key.txt'), 'r') as f:
+            return f.read().strip() == image_store_key(fname, image_size)
+    except IOError:
+        return False
+
+def build_image_store(fname, store_dir, image_size=(224, 224), separator='\t'):
+    """Decodes and resizes every image of a label file once into a uint8 memmap.
+
+    `store_dir` gets `images.npy` with one resized image per row, plus
+    `labels.npy` and `paths.txt` indexing the same rows and `key.txt`
+    with the hash of the label file. Images that cannot be opened are
+    skipped, like `load_path_label` does. `images.npy` is moved into place
+    last, so an interrupted build leaves no store behind.
+    """
+    with open(fname, 'r') as f:
+        lines = [x.strip().split(separator) for x in f if x.strip()]
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    if os.path.exists(os.path.join(store_dir, 'images.npy')):
+        # a store of another label file, invalid until the new one is complete
+        os.remove(os.path.join(store_dir, 'images.npy'))
+    images = np.lib.format.open_memmap(os.path.join(store_dir, 'images.npy.tmp'), mode='w+', dtype=np.uint8,
+                                       shape=(len(lines), image_size[0], image_size[1], 3))
+    labels = []
+    filepaths = []
+    for x in lines:
+        try:
+            raw_image = Image.open(x[0]).convert('RGB')
+        except IOError:
+            print(x[0])
+            continue
+        images[len(filepaths)] = imresize(raw_image, list(image_size))
+        labels.append(int(x[1]))
+        filepaths.append(x[0])
+    images.flush()
+    del images
+    np.save(os.path.join(store_dir, 'labels.npy'), np.array(labels, dtype=np.int64))
+    with open(os.path.join(store_dir, 'paths.txt'), 'w') as f:
+        f.writelines('{}\n'.format(p) for p in filepaths)
+    with open(os.path.join(store_dir, 'key.txt'), 'w') as f:
+        f.write(image_store_key(fname, image_size))
+    os.rename(os.path.join(store_dir, 'images.npy.tmp'), os.path.join(store_dir, 'images.npy'))
+
+def load_image_store(store_dir, batch_shape, shuffle=True, onehot=False):
+    """Same batches as `load_path_label`, served from a store written by `build_image_store`."""
+    batch_size = batch_shape[0]
+    bn_classes = 110
+    with open(os.path.join(store_dir, 'paths.txt'), 'r') as f:
+        filepaths = [x.rstrip('\n') for x in f]
+    all_labels = np.load(os.path.join(store_dir, 'labels.npy'))
+    # rows past len(filepaths) belong to images that failed to decode
+    store = np.load(os.path.join(store_dir, 'images.npy'), mmap_mode='r')[:len(filepaths)]
+
+    order = np.arange(len(filepaths))
+    if shuffle:
+        np.random.shuffle(order)
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start + batch_size]
+        n = len(idx)
+        images = np.zeros(batch_shape, dtype=np.float32)
+        np.multiply(store[idx], 2.0 / 255.0, out=images[:n], casting='unsafe')
+        images[:n] -= 1.0
+        if onehot:
+            labels = np.zeros([batch_size, bn_classes], dtype=np.float32)
+            labels[np.arange(n), all_labels[idx]] = 1
+        else:
+            labels = all_labels[idx].tolist()
+        yield images, labels, [filepaths[i] for i in idx]
+
+_decode_slots = None
+
+def _init_decode_worker(shared_slots, slot_shape):
+    global _decode_slots
+    _decode_slots = [np.frombuffer(buf, dtype=np.uint8).reshape(slot_shape) for buf in shared_slots]
+
+def _decode_rows(slot, start, filepaths, image_size):
+    ok = []
+    for i, filepath in enumerate(filepaths):
+        try:
+            raw_image = Image.open(filepath).convert('RGB')
+        except IOError:
+            print(filepath)
+            ok.append(False)
+            continue
+        _decode_slots[slot][start + i] = imresize(raw_image, image_size)
+        ok.append(True)
+    return ok
+
+class DecodePool(object):
+    """Worker processes and shared memory slots `load_path_label_parallel` decodes into.
+
+    Forking once a TF session exists can deadlock the children, so scripts
+    create the pool before building their graph and pass it to every
+    `load_path_label` call, which also keeps the workers across epochs.
+    """
+    def __init__(self, batch_shape, num_workers=4, prefetch=2):
+        self.num_workers = num_workers
+        slot_shape = list(batch_shape)
+        shared_slots = [multiprocessing.RawArray('B', int(np.prod(slot_shape))) for _ in range(prefetch)]
+        self.slots = [np.frombuffer(buf, dtype=np.uint8).reshape(slot_shape) for buf in shared_slots]
+        self.pool = multiprocessing.Pool(num_workers, _init_decode_worker, (shared_slots, slot_shape))
+
+    def close(self):
+        self.pool.terminate()
+
+def load_path_label_parallel(fname, batch_shape, separator='\t', shuffle=True, onehot=False, num_workers=4, prefetch=2, seed=None,
+                             pool=None):
+    """Same batches as `load_path_label`, decoded and resized by a process pool.
+
+    Each batch is split across `num_workers` processes, which write the
+    resized uint8 pixels straight into one of `prefetch` shared memory
+    slots, so at most `prefetch` batches are decoded ahead of the consumer.
+    Lines are shuffled with `seed` and batches come out in order, so the
+    output is deterministic for a given seed. Images that fail to decode
+    are dropped from their own batch instead of being back-filled. Without
+    a `DecodePool` passed as `pool`, one is created for this call only.
+    """
+    batch_size = batch_shape[0]
+    bn_classes = 110
+    image_size = list(batch_shape[1:3])
+    with open(fname, 'r') as f:
+        lines = [x.strip().split(separator) for x in f if x.strip()]
+    if shuffle:
+        random.Random(seed).shuffle(lines)
+    batches = [lines[i:i + batch_size] for i in range(0, len(lines), batch_size)]
+
+    own_pool = pool is None
+    if own_pool:
+        pool = DecodePool(batch_shape, num_workers, prefetch)
+    slots = pool.slots
+    prefetch = len(slots)
+    chunk = max(1, -(-batch_size // pool.num_workers))
+
+    def submit(b, slot):
+        paths = [x[0] for x in batches[b]]
+        return [pool.pool.apply_async(_decode_rows, (slot, start, paths[start:start + chunk], image_size))
+                for start in range(0, len(paths), chunk)]
+
+    pending = deque()
+    try:
+        for b in range(min(prefetch, len(batches))):
+            pending.append((b, b, submit(b, b)))
+        next_batch = len(pending)
+        while pending:
+            b, slot, results = pending.popleft()
+            ok = np.array(sum([res.get() for res in results], []), dtype=bool)
+            rows = [x for x, valid in zip(batches[b], ok) if valid]
+            n = len(rows)
+            images = np.zeros(batch_shape, dtype=np.float32)
+            np.multiply(slots[slot][:len(ok)][ok], 2.0 / 255.0, out=images[:n], casting='unsafe')
+            images[:n] -= 1.0
+            # the slot has been copied out, hand it to the next batch
+            if next_batch < len(batches):
+                pending.append((next_batch, slot, submit(next_batch, slot)))
+                next_batch += 1
+
+            if onehot:
+                labels = np.zeros([batch_size, bn_classes], dtype=np.float32)
+                labels[np.arange(n), [int(x[1]) for x in rows]] = 1
+            else:
+                labels = [int(x[1]) for x in rows]
+            yield images, labels, [x[0] for x in rows]
+    finally:
+        if own_pool:
+            pool.close()
+        else:
+            # a shared pool must not write into the slots of the next call
+            for _, _, results in pending:
+                for res in results:
+                    res.wait()
+
+def load_path_label(fname=None, batch_shape=None, separator='\t', shuffle=True, onehot=False, store_dir=None,
+                    num_workers=0, prefetch=2, seed=None, pool=None):
+    if store_dir:
+        if not image_store_valid(fname, store_dir, batch_shape[1:3]):
+            build_image_store(fname, store_dir, batch_shape[1:3], separator)
+        for batch in load_image_store(store_dir, batch_shape, shuffle, onehot):
+            yield batch
+        return
+    if num_workers > 0 or pool is not None:
+        for batch in load_path_label_parallel(fname, batch_shape, separator, shuffle, onehot, num_workers, prefetch, seed, pool):
+            yield batch
+        return
+
     batch_size = batch_shape[0]
     bn_classes = 110
     images = np.zeros(batch_shape, dtype=np.float32)
@@ -61,6 +261,132 @@ def load_path_label(fname=None, batch_shape=None, separator='\t', shuffle=True,
         if idx > 0:
             yield images, labels, filepaths
 
+def cycle_path_label(fname, batch_shape, **kwargs):
+    """`load_path_label` started over after every pass through the label file."""
+    while True:
+        for batch in load_path_label(fname, batch_shape, **kwargs):
+            yield batch
+
+def checkpoint_fingerprint(checkpoint_path):
+    """Hashes the path, size and mtime of every file of a checkpoint."""
+    sha = hashlib.sha1()
+    for fn in sorted(glob.glob(checkpoint_path + '*')):
+        stat = os.stat(fn)
+        sha.update('{}:{}:{}\n'.format(os.path.abspath(fn), stat.st_size, int(stat.st_mtime)).encode('utf-8'))
+    return sha.hexdigest()
+
+class FeatureStore(object):
+    """Memory-mapped cache of classifier outputs for the images of a label file.
+
+    Rows follow the order of the label file `fname`. The cache lives in a
+    subdirectory of `cache_dir` named after the label file and the
+    classifier `fingerprint`, so changing either starts a fresh cache
+    instead of serving stale features.
+    """
+    def __init__(self, cache_dir, fname, fingerprint, separator='\t'):
+        with open(fname, 'r') as f:
+            paths = [x.strip().split(separator)[0] for x in f if x.strip()]
+        key = hashlib.sha1(('\n'.join(paths) + '\n' + fingerprint).encode('utf-8')).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, key)
+        self.rows = dict((p, i) for i, p in enumerate(paths))
+        self.size = len(paths)
+        self.features = None
+        self.labels = None
+        self.pred_val = None
+        self.valid = None
+        if os.path.exists(self._path('valid')):
+            self._open('r+')
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def _open(self, mode, feature_shape=None, dtype=None):
+        if mode == 'w+' and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        open_memmap = np.lib.format.open_memmap
+        def _memmap(name, shape, dtype):
+            if mode == 'w+':
+                return open_memmap(self._path(name), mode=mode, dtype=dtype, shape=shape)
+            return open_memmap(self._path(name), mode=mode)
+        self.features = _memmap('features', (self.size,) + tuple(feature_shape or ()), dtype)
+        self.labels = _memmap('labels', (self.size,), np.int64)
+        self.pred_val = _memmap('pred_val', (self.size,), np.float32)
+        # written last, so a row is only trusted once its outputs are on disk
+        self.valid = _memmap('valid', (self.size,), np.uint8)
+
+    def get(self, filepaths, images, extract_feature):
+        """Returns `extract_feature(images)`, computing only rows missing from the cache."""
+        if any(p not in self.rows for p in filepaths):
+            return extract_feature(images)
+        rows = np.array([self.rows[p] for p in filepaths])
+        if self.valid is None:
+            miss = np.arange(len(rows))
+        else:
+            miss = np.flatnonzero(self.valid[rows] == 0)
+        if len(miss) > 0:
+            features, labels, pred_val = extract_feature(images[miss])
+            if self.valid is None:
+                self._open('w+', features.shape[1:], features.dtype)
+            self.features[rows[miss]] = features
+            self.labels[rows[miss]] = labels
+            self.pred_val[rows[miss]] = pred_val
+            self.valid[rows[miss]] = 1
+        return np.array(self.features[rows]), np.array(self.labels[rows]), np.array(self.pred_val[rows])
+
+    def refresh(self):
+        """Opens the cache files if another process has created them since, returns whether they are open."""
+        if self.valid is None and os.path.exists(self._path('valid')):
+            try:
+                self._open('r+')
+            except (ValueError, IOError):
+                # the creating process is still writing the headers
+                self.features = self.labels = self.pred_val = self.valid = None
+        return self.valid is not None
+
+    def flush(self):
+        if self.valid is not None:
+            for arr in [self.features, self.labels, self.pred_val, self.valid]:
+                arr.flush()
+
+class BackgroundWriter(object):
+    """Runs `fn(*args)` for output files on a pool of worker processes.
+
+    At most `max_pending` jobs wait at a time, `submit` blocks beyond that
+    so a burst of successes cannot pile up arrays in memory. `close` waits
+    for every submitted job and is registered with atexit. With
+    `num_workers=0` the jobs run inline. With `threads` the pool is made of
+    threads, for daemonic processes that cannot start worker processes.
+    """
+    def __init__(self, fn, num_workers=2, max_pending=32, threads=False):
+        self.fn = fn
+        self.pool = None
+        if num_workers > 0:
+            self.pool = ThreadPool(num_workers) if threads else multiprocessing.Pool(num_workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.failures = 0
+        atexit.register(self.close)
+
+    def submit(self, *args):
+        if self.pool is None:
+            self.fn(*args)
+            return
+        self.pending.acquire()
+        self.pool.apply_async(self.fn, args, callback=self._done, error_callback=self._failed)
+
+    def _done(self, _):
+        self.pending.release()
+
+    def _failed(self, e):
+        self.failures += 1
+        print('Background write failed: {}'.format(e))
+        self.pending.release()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
 if __name__ == "__main__":
     generate_txt_label(data_path="./datasets/adversarial-examples", labeltxt_path="./datasets/adversarial_labels.txt")
     #data = load_path_label("./labels.txt", batch_shape=[4, 224, 224, 3])
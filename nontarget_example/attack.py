@@ -6,6 +6,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import os
+import time
+import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.slim.nets import inception
@@ -31,15 +35,22 @@ tf.flags.DEFINE_integer(
     'batch_size', 16, 'How many images process at one time.')
 tf.flags.DEFINE_integer(
     'num_classes', 110, 'Number of Classes')
+tf.flags.DEFINE_integer(
+    'num_workers', 0, 'Processes that each attack a shard of the input images with their own session, 0 to attack in this process')
+tf.flags.DEFINE_integer(
+    'intra_op_threads', 0, 'Intra-op thread budget of every session, 0 for the TensorFlow default')
+tf.flags.DEFINE_integer(
+    'num_encoders', 4, 'Threads that resize and encode the output images, 0 to encode inline')
 FLAGS = tf.flags.FLAGS
 
 
-def load_images(input_dir, batch_shape):
+def load_images(input_dir, batch_shape, shard=0, num_shards=1):
     images = np.zeros(batch_shape)
     filenames = []
     idx = 0
     batch_size = batch_shape[0]
-    for filepath in tf.gfile.Glob(os.path.join(input_dir, '*.png')):
+    # every worker globs on its own, sorting gives them all the same order to shard
+    for filepath in sorted(tf.gfile.Glob(os.path.join(input_dir, '*.png')))[shard::num_shards]:
         with open(filepath, 'rb') as f:
             raw_image = imread(f, mode='RGB')
             image = imresize(raw_image, [FLAGS.image_height, FLAGS.image_width]).astype(np.float)
@@ -56,15 +67,22 @@ def load_images(input_dir, batch_shape):
         yield filenames, images
 
 
-def save_images(images, filenames, output_dir):
-    for i, filename in enumerate(filenames):
-        # Images for inception classifier are normalized to be in [-1, 1] interval,
-        # so rescale them back to [0, 1].
-        with open(os.path.join(output_dir, filename), 'w') as f:
-            img = (((images[i, :, :, :] + 1.0) * 0.5) * 255.0).astype(np.uint8)
-            # resize back to [299, 299]
-            r_img = imresize(img, [299, 299])
-            Image.fromarray(r_img).save(f, format='JPEG')
+def save_image(image, filename, output_dir):
+    start = time.time()
+    # Images for inception classifier are normalized to be in [-1, 1] interval,
+    # so rescale them back to [0, 1].
+    img = (((image + 1.0) * 0.5) * 255.0).astype(np.uint8)
+    # resize back to [299, 299]
+    r_img = imresize(img, [299, 299])
+    Image.fromarray(r_img).save(os.path.join(output_dir, filename), format='JPEG')
+    return time.time() - start
+
+
+def save_images(images, filenames, output_dir, pool=None):
+    """Saves the images, returns the encode seconds or, with `pool`, the pending results."""
+    if pool is None:
+        return sum(save_image(images[i], filename, output_dir) for i, filename in enumerate(filenames))
+    return [pool.apply_async(save_image, (images[i], filename, output_dir)) for i, filename in enumerate(filenames)]
 
 
 class InceptionModel(Model):
@@ -98,27 +116,77 @@ class InceptionModel(Model):
         return self(x_input)
 
 
-def main(_):
-    """Run the sample attack"""
+def run_shard(shard, num_shards=1):
+    """Attacks every `num_shards`-th input image starting at `shard`, returns the stage timings."""
     batch_shape = [FLAGS.batch_size, FLAGS.image_height, FLAGS.image_width, 3]
     nb_classes = FLAGS.num_classes
     tf.logging.set_verbosity(tf.logging.INFO)
+    config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=True,
+                            intra_op_parallelism_threads=FLAGS.intra_op_threads)
+    # several workers share the GPU
+    config.gpu_options.allow_growth = num_shards > 1
+    stats = {'images': 0, 'load': 0.0, 'attack': 0.0, 'encode': 0.0}
+    start = time.time()
 
     with tf.Graph().as_default():
         # Prepare graph
         x_input = tf.placeholder(tf.float32, shape=batch_shape)
         model = InceptionModel(nb_classes)
         # Run computation
-        with tf.Session(config=tf.ConfigProto(allow_soft_placement=True, log_device_placement=True)) as sess:
+        with tf.Session(config=config) as sess:
             fgsm_model = FastGradientMethod(model, sess=sess)
             attack_params = {"eps": 32.0 / 255.0, "clip_min": -1.0, "clip_max": 1.0}
             x_adv = fgsm_model.generate(x_input, **attack_params)
             saver = tf.train.Saver(slim.get_model_variables())
             saver.restore(sess, FLAGS.checkpoint_path)
 
-            for filenames, images in load_images(FLAGS.input_dir, batch_shape):
+            pool = ThreadPool(FLAGS.num_encoders) if FLAGS.num_encoders > 0 else None
+            pending = []
+            batches = load_images(FLAGS.input_dir, batch_shape, shard, num_shards)
+            while True:
+                t = time.time()
+                batch = next(batches, None)
+                stats['load'] += time.time() - t
+                if batch is None:
+                    break
+                filenames, images = batch
+                t = time.time()
                 adv_images = sess.run(x_adv, feed_dict={x_input: images})
-                save_images(adv_images, filenames, FLAGS.output_dir)
+                stats['attack'] += time.time() - t
+                if pool is None:
+                    stats['encode'] += save_images(adv_images, filenames, FLAGS.output_dir)
+                else:
+                    pending.extend(save_images(adv_images, filenames, FLAGS.output_dir, pool))
+                stats['images'] += len(filenames)
+            # encoder threads overlap the attack, their time is summed over threads
+            stats['encode'] += sum(result.get() for result in pending)
+            if pool is not None:
+                pool.close()
+                pool.join()
+    stats['wall'] = time.time() - start
+    tf.logging.info('Shard %d: %d images in %.1fs (load %.1fs, attack %.1fs, encode %.1fs), %.2f images/second',
+                    shard, stats['images'], stats['wall'], stats['load'], stats['attack'], stats['encode'],
+                    stats['images'] / max(stats['wall'], 1e-6))
+    return stats
+
+
+def main(_):
+    """Run the sample attack"""
+    if FLAGS.num_workers <= 0:
+        run_shard(0)
+        return
+    # the workers are forked before this process builds any graph
+    start = time.time()
+    pool = multiprocessing.Pool(FLAGS.num_workers)
+    stats = pool.map(functools.partial(run_shard, num_shards=FLAGS.num_workers), range(FLAGS.num_workers), chunksize=1)
+    pool.close()
+    pool.join()
+    wall = time.time() - start
+    images = sum(x['images'] for x in stats)
+    tf.logging.set_verbosity(tf.logging.INFO)
+    tf.logging.info('%d workers: %d images in %.1fs (load %.1fs, attack %.1fs, encode %.1fs summed over workers), %.2f images/second',
+                    FLAGS.num_workers, images, wall, sum(x['load'] for x in stats), sum(x['attack'] for x in stats),
+                    sum(x['encode'] for x in stats), images / max(wall, 1e-6))
 
 
 if __name__ == '__main__':
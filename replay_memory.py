@@ -0,0 +1,404 @@
+import os
+import multiprocessing
+import numpy as np
+
+
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+
+
+def quantize(x):
+    # symmetric int8 with one scale per sample and channel (last axis)
+    x = np.asarray(x, dtype=np.float32)
+    axes = tuple(range(1, x.ndim - 1))
+    scale = np.abs(x).max(axis=axes) / 127.0 if axes else np.abs(x) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.rint(x / _expand(scale, x.ndim)).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def dequantize(q, scale):
+    return q.astype(np.float32) * _expand(scale, q.ndim)
+
+
+def _expand(scale, ndim):
+    return scale.reshape(scale.shape[:1] + (1,) * (ndim - 2) + scale.shape[1:])
+
+
+#####################  Memory  ####################
+class Memory(object):
+    """Replay memory backed by preallocated numpy arrays.
+
+    Transitions are written into a ring buffer of contiguous
+    `states`/`actions`/`rewards`/`next_states` arrays. The arrays are
+    allocated on the first `store_transition` call, so the same class
+    works for every state/action shape used by the ddpg scripts.
+    `sample` gathers a whole minibatch with one fancy index per array and
+    returns batches that can be fed to `feed_dict` as they are.
+
+    `storage` selects how states and actions are kept: 'float32' as they
+    are, 'float16', or 'int8' with a per-channel scale for every sample.
+    Sampled batches are always dequantized back to float32.
+
+    With `directory` set, every array is a memory-mapped `.npy` file there
+    and `header.npy` holds `[pointer, size, capacity, state_count]`
+    followed by the storage mode and the state and action shapes. The OS
+    pages the arrays in and out, and a new Memory on the same directory
+    continues from the transitions of the previous run, as long as it
+    stores the same shapes in the same storage mode.
+
+    With `share_states`, `states` is a ring of its own and every transition
+    keeps the ids of its two states in `state_refs`, so the `s_` of one
+    step is stored once and reused as the `s` of the next. `store_batch`
+    returns the ids of the stored `s_`, to be passed back as `s_ref` with
+    the following transition of the same episode. Ids count every state
+    ever stored, so a transition whose state was overwritten is detected
+    and never sampled.
+    """
+    HEADER = 'header.npy'
+
+    def __init__(self, capacity, storage='float32', directory=None, share_states=False):
+        if storage not in STORAGE_DTYPES:
+            raise ValueError('Unknown storage mode {}, expected one of {}'.format(storage, sorted(STORAGE_DTYPES)))
+        self.capacity = capacity
+        self.storage = storage
+        self.share_states = share_states
+        self.pointer = 0
+        self.size = 0
+        self.state_count = 0
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.next_states = None
+        self.state_refs = None
+        self.state_shape = None
+        self.action_shape = None
+        self.scales = {}
+        # running squared reconstruction error of states and actions
+        self.sq_error = {'states': 0.0, 'actions': 0.0}
+        self.sq_count = {'states': 0, 'actions': 0}
+        self.directory = directory
+        self.header = None
+        if directory:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            if os.path.exists(os.path.join(directory, self.HEADER)):
+                self._open()
+
+    @property
+    def _arrays(self):
+        if self.share_states:
+            return ('states', 'actions', 'rewards', 'state_refs')
+        return ('states', 'actions', 'rewards', 'next_states')
+
+    @property
+    def _quantized(self):
+        return ('states', 'actions') if self.share_states else ('states', 'actions', 'next_states')
+
+    def _open(self):
+        header = np.load(os.path.join(self.directory, self.HEADER), mmap_mode='r+')
+        if header[2] != self.capacity:
+            raise ValueError('Replay memory in {} has capacity {}, expected {}'.format(self.directory, header[2], self.capacity))
+        if os.path.exists(os.path.join(self.directory, 'state_refs.npy')) != self.share_states:
+            raise ValueError('Replay memory in {} was stored with share_states={}'.format(self.directory, not self.share_states))
+        for key in self._arrays:
+            setattr(self, key, np.load(os.path.join(self.directory, key + '.npy'), mmap_mode='r+'))
+        if len(header) > 4:
+            storage = sorted(STORAGE_DTYPES)[header[4]]
+            if storage != self.storage:
+                raise ValueError('Replay memory in {} is stored as {}, expected {}'.format(self.directory, storage, self.storage))
+            n = header[5]
+            self.state_shape = tuple(int(x) for x in header[6:6 + n])
+            self.action_shape = tuple(int(x) for x in header[7 + n:7 + n + header[6 + n]])
+        else:
+            # written before the header held the shapes
+            self.state_shape, self.action_shape = self.states.shape[1:], self.actions.shape[1:]
+        for key in self._quantized:
+            x = getattr(self, key)
+            shape = self.action_shape if key == 'actions' else self.state_shape
+            if x.dtype != STORAGE_DTYPES[self.storage] or x.shape != (self.capacity,) + shape:
+                raise ValueError('Replay memory in {} has {} of {} {}, expected {} {}'.format(
+                    self.directory, key, x.dtype, x.shape[1:], np.dtype(STORAGE_DTYPES[self.storage]), shape))
+        if self.storage == 'int8':
+            for key in self._quantized:
+                self.scales[key] = np.load(os.path.join(self.directory, 'scales_' + key + '.npy'), mmap_mode='r+')
+        self.header = header
+        self.pointer, self.size = int(header[0]), int(header[1])
+        if len(header) > 3:
+            self.state_count = int(header[3])
+
+    def _zeros(self, name, shape, dtype):
+        if not self.directory:
+            return np.zeros(shape, dtype=dtype)
+        return np.lib.format.open_memmap(os.path.join(self.directory, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    def _allocate(self, s, a):
+        s = np.asarray(s)
+        a = np.asarray(a)
+        self.state_shape, self.action_shape = s.shape, a.shape
+        dtype = STORAGE_DTYPES[self.storage]
+        self.states = self._zeros('states', (self.capacity,) + s.shape, dtype)
+        self.actions = self._zeros('actions', (self.capacity,) + a.shape, dtype)
+        # keep rewards as a column so that R + gamma * q_ stays [batch, 1]
+        self.rewards = self._zeros('rewards', (self.capacity, 1), np.float32)
+        if self.share_states:
+            self.state_refs = self._zeros('state_refs', (self.capacity, 2), np.int64)
+        else:
+            self.next_states = self._zeros('next_states', (self.capacity,) + s.shape, dtype)
+        if self.storage == 'int8':
+            for key in self._quantized:
+                shape = a.shape if key == 'actions' else s.shape
+                self.scales[key] = self._zeros('scales_' + key, (self.capacity,) + shape[-1:], np.float32)
+                self.scales[key][:] = 1.0
+        if self.directory:
+            # the header is written last, so an interrupted allocation is not picked up as a memory
+            header = [self.pointer, self.size, self.capacity, self.state_count, sorted(STORAGE_DTYPES).index(self.storage)]
+            header += [len(s.shape)] + list(s.shape) + [len(a.shape)] + list(a.shape)
+            self.header = self._zeros('header', (len(header),), np.int64)
+            self.header[:] = header
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        arrays = [getattr(self, key) for key in self._arrays] + list(self.scales.values())
+        return sum(x.nbytes for x in arrays if x is not None)
+
+    def reconstruction_error(self):
+        """Root mean squared error between stored and original states/actions."""
+        return dict((key, np.sqrt(self.sq_error[key] / self.sq_count[key]) if self.sq_count[key] else 0.0)
+                    for key in self.sq_error)
+
+    def _write(self, key, indices, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self.storage == 'int8':
+            q, scale = quantize(x)
+            getattr(self, key)[indices] = q
+            self.scales[key][indices] = scale
+            restored = dequantize(q, scale)
+        else:
+            getattr(self, key)[indices] = x
+            restored = getattr(self, key)[indices]
+        if self.storage != 'float32' and key in self.sq_error:
+            self.sq_error[key] += float(np.square(restored - x).sum())
+            self.sq_count[key] += x.size
+
+    def _read(self, key, indices):
+        x = getattr(self, key)[indices]
+        if self.storage == 'int8':
+            return dequantize(x, self.scales[key][indices])
+        return x.astype(np.float32, copy=False)
+
+    def _store_states(self, x):
+        ids = self.state_count + np.arange(len(x))
+        self._write('states', ids % self.capacity, x)
+        self.state_count += len(x)
+        return ids
+
+    def _valid(self, indices):
+        if not self.share_states:
+            return np.ones(len(indices), dtype=bool)
+        # s is never newer than s_, so only s can have been overwritten
+        return self.state_refs[indices, 0] >= self.state_count - self.capacity
+
+    def store_transition(self, s, a, r, s_, s_ref=None):
+        refs = self.store_batch([s], [a], [r], [s_], None if s_ref is None else [s_ref])
+        return None if refs is None else refs[0]
+
+    def store_batch(self, s, a, r, s_, s_ref=None):
+        n = len(s)
+        if self.states is None:
+            self._allocate(s[0], a[0])
+        elif np.shape(s[0]) != self.state_shape or np.shape(a[0]) != self.action_shape:
+            raise ValueError('Replay memory stores states of {} and actions of {}, got {} and {}'.format(
+                self.state_shape, self.action_shape, np.shape(s[0]), np.shape(a[0])))
+        indices = (self.pointer + np.arange(n)) % self.capacity
+        refs = None
+        if self.share_states:
+            s_ids = np.full(n, -1, dtype=np.int64) if s_ref is None else np.array(s_ref, dtype=np.int64)
+            # unknown (-1) or already overwritten states are stored again
+            missing = (s_ids < 0) | (s_ids < self.state_count - self.capacity)
+            if missing.any():
+                s_ids[missing] = self._store_states(np.asarray(s)[missing])
+            refs = self._store_states(s_)
+            self.state_refs[indices, 0] = s_ids
+            self.state_refs[indices, 1] = refs
+        else:
+            self._write('states', indices, s)
+            self._write('next_states', indices, s_)
+        self._write('actions', indices, a)
+        self.rewards[indices] = np.reshape(r, (n, 1))
+        self.pointer = (self.pointer + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        if self.header is not None:
+            # transitions are written before the header moves past them
+            self.header[:2] = [self.pointer, self.size]
+            self.header[3] = self.state_count
+        return refs
+
+    def flush(self):
+        if self.header is None:
+            return
+        for x in [getattr(self, key) for key in self._arrays] + list(self.scales.values()):
+            x.flush()
+        self.header.flush()
+
+    def _gather(self, indices):
+        if self.share_states:
+            refs = self.state_refs[indices] % self.capacity
+            return (self._read('states', refs[:, 0]), self._read('actions', indices),
+                    self.rewards[indices], self._read('states', refs[:, 1]))
+        return (self._read('states', indices), self._read('actions', indices),
+                self.rewards[indices], self._read('next_states', indices))
+
+    def sample(self, n):
+        indices = np.random.randint(0, self.size, size=n)
+        invalid = ~self._valid(indices)
+        while invalid.any():
+            indices[invalid] = np.random.randint(0, self.size, size=invalid.sum())
+            invalid = ~self._valid(indices)
+        return self._gather(indices)
+
+
+class SumTree(object):
+    """Binary tree in a flat array where every node holds the sum of its children.
+
+    Leaf `i` sits at `i + capacity - 1`. Updating a priority and finding
+    the leaf of a cumulative value both walk one root-to-leaf path.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tree = np.zeros(2 * capacity - 1, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[0]
+
+    def update(self, indices, priorities):
+        for i, p in zip(np.ravel(indices), np.ravel(priorities)):
+            idx = i + self.capacity - 1
+            change = p - self.tree[idx]
+            self.tree[idx] = p
+            while idx != 0:
+                idx = (idx - 1) // 2
+                self.tree[idx] += change
+
+    def find(self, values):
+        # walk all values down the tree together, leaves may sit at two different depths
+        idx = np.zeros(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        inner = idx < self.capacity - 1
+        while inner.any():
+            left = 2 * idx[inner] + 1
+            go_right = values[inner] >= self.tree[left]
+            values[inner] -= np.where(go_right, self.tree[left], 0.0)
+            idx[inner] = left + go_right
+            inner = idx < self.capacity - 1
+        return idx - (self.capacity - 1), self.tree[idx]
+
+
+class PrioritizedMemory(Memory):
+    """Memory that samples transitions in proportion to their TD error.
+
+    New transitions get the largest priority `update_priorities` has set so
+    far, or the upper bound before the first update. `sample` returns
+    the tree indices and importance-sampling weights next to the batch,
+    and `update_priorities` takes the absolute TD errors of that batch.
+    """
+    epsilon = 0.01  # keeps every transition reachable
+    alpha = 0.6  # how much prioritization is used, 0 is uniform
+    beta = 0.4  # importance-sampling correction, annealed to 1
+    beta_increment_per_sampling = 0.001
+    abs_err_upper = 1.0  # clipped abs error
+
+    def __init__(self, capacity, storage='float32', directory=None, share_states=False):
+        self.tree = SumTree(capacity)
+        self.max_priority = 0.0
+        super(PrioritizedMemory, self).__init__(capacity, storage, directory, share_states)
+        if self.size:
+            # priorities are not persisted, start restored transitions at the upper bound
+            self.tree.update(np.arange(self.size), np.full(self.size, self.abs_err_upper))
+
+    def store_batch(self, s, a, r, s_, s_ref=None):
+        indices = (self.pointer + np.arange(len(s))) % self.capacity
+        refs = super(PrioritizedMemory, self).store_batch(s, a, r, s_, s_ref)
+        self.tree.update(indices, np.full(len(indices), self.max_priority or self.abs_err_upper))
+        return refs
+
+    def _find(self, values):
+        indices, _ = self.tree.find(values)
+        # rounding can walk past the last stored transition
+        return np.minimum(indices, self.size - 1)
+
+    def sample(self, n):
+        segment = self.tree.total / n
+        indices = self._find((np.arange(n) + np.random.uniform(size=n)) * segment)
+        invalid = ~self._valid(indices)
+        while invalid.any():
+            # transitions whose state was overwritten drop out of the tree
+            dropped = np.unique(indices[invalid])
+            self.tree.update(dropped, np.zeros(len(dropped)))
+            indices[invalid] = self._find(np.random.uniform(0, self.tree.total, size=invalid.sum()))
+            invalid = ~self._valid(indices)
+        priorities = self.tree.tree[indices + self.capacity - 1]
+        self.beta = min(1.0, self.beta + self.beta_increment_per_sampling)
+
+        probs = priorities / self.tree.total
+        weights = np.power(self.size * probs, -self.beta)
+        weights = (weights / weights.max()).astype(np.float32)
+        return self._gather(indices) + (indices, weights.reshape(-1, 1))
+
+    def update_priorities(self, indices, abs_errors):
+        abs_errors = np.minimum(np.abs(np.ravel(abs_errors)) + self.epsilon, self.abs_err_upper)
+        priorities = np.power(abs_errors, self.alpha)
+        self.tree.update(indices, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+
+class TransitionSlots(object):
+    """Ring of shared memory slots that hands transition batches from actor processes to the learner.
+
+    An actor writes a batch of up to `batch_size` transitions into a free
+    slot and only puts `(actor_id, slot, n)` on a queue, so the arrays are
+    never pickled. `get` returns views into the slot, which stay valid
+    until the slot is given back with `release`. `close` tells the learner
+    that an actor puts no more batches, `get` returns None for it. The
+    ring has to be created before the actors are forked.
+    """
+    fields = ['slots', 'fresh', 'states', 'actions', 'rewards', 'next_states']
+
+    def __init__(self, num_slots, batch_size, state_shape, action_shape):
+        shapes = {'slots': (), 'fresh': (), 'states': tuple(state_shape), 'actions': tuple(action_shape),
+                  'rewards': (), 'next_states': tuple(state_shape)}
+        dtypes = {'slots': np.int64, 'fresh': np.bool_}
+        self.arrays = {}
+        for key, shape in shapes.items():
+            dtype = np.dtype(dtypes.get(key, np.float32))
+            shape = (num_slots, batch_size) + shape
+            buf = multiprocessing.RawArray('B', int(np.prod(shape)) * dtype.itemsize)
+            self.arrays[key] = np.frombuffer(buf, dtype=dtype).reshape(shape)
+        self.free = multiprocessing.Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+        self.filled = multiprocessing.Queue()
+
+    def put(self, actor_id, slots, fresh, s, a, r, s_):
+        n = len(slots)
+        slot = self.free.get()
+        for key, x in zip(self.fields, [slots, fresh, s, a, r, s_]):
+            self.arrays[key][slot, :n] = x
+        self.filled.put((actor_id, slot, n))
+
+    def get(self, block=True, timeout=None):
+        """Returns `(slot, (actor_id, slots, fresh, s, a, r, s_))`, or None once an actor has closed."""
+        item = self.filled.get(block, timeout)
+        if item is None:
+            return None
+        actor_id, slot, n = item
+        return slot, (actor_id,) + tuple(self.arrays[key][slot, :n] for key in self.fields)
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def close(self):
+        self.filled.put(None)
@@ -7,6 +7,10 @@ from __future__ import division
 from __future__ import print_function
 import os
 import csv
+import time
+import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.slim.nets import inception
@@ -30,18 +34,29 @@ tf.flags.DEFINE_integer(
     'batch_size', 16, 'How many images process at one time.')
 tf.flags.DEFINE_integer(
     'num_classes', 110, 'Number of Classes')
+tf.flags.DEFINE_integer(
+    'num_workers', 0, 'Processes that each attack a shard of dev.csv with their own session, 0 to attack in this process')
+tf.flags.DEFINE_integer(
+    'intra_op_threads', 0, 'Intra-op thread budget of every session, 0 for the TensorFlow default')
+tf.flags.DEFINE_boolean(
+    'early_stop', False, 'Stop attacking each image once it is classified as its target label')
+tf.flags.DEFINE_integer(
+    'num_encoders', 4, 'Threads that resize and encode the output PNGs, 0 to encode inline')
 FLAGS = tf.flags.FLAGS
 
 
-def load_images(input_dir, batch_shape):
-    images = np.zeros(batch_shape)
+def load_images(input_dir, batch_shape, shard=0, num_shards=1):
+    # one float32 buffer for all batches, every batch is consumed before the next is read
+    images = np.zeros(batch_shape, dtype=np.float32)
     labels = np.zeros(batch_shape[0], dtype=np.int32)
     filenames = []
     idx = 0
     batch_size = batch_shape[0]
     with open(os.path.join(input_dir, 'dev.csv'), 'rb') as f:
         reader = csv.DictReader(f)
-        for row in reader:
+        for i, row in enumerate(reader):
+            if i % num_shards != shard:
+                continue
             filepath = os.path.join(input_dir, row['filename'])
             with open(filepath) as f:
                 raw_image = imread(f, mode='RGB').astype(np.float)
@@ -54,22 +69,27 @@ def load_images(input_dir, batch_shape):
             if idx == batch_size:
                 yield filenames, images, labels
                 filenames = []
-                images = np.zeros(batch_shape)
-                labels = np.zeros(batch_shape[0], dtype=np.int32)
                 idx = 0
         if idx > 0:
-            yield filenames, images, labels
+            yield filenames, images[:idx], labels[:idx]
+
+
+def save_image(image, filename, output_dir):
+    start = time.time()
+    # Images for inception classifier are normalized to be in [-1, 1] interval,
+    # so rescale them back to [0, 1].
+    img = (((image + 1.0) * 0.5) * 255.0).astype(np.uint8)
+    # resize back to [299, 299]
+    r_img = imresize(img, [299, 299])
+    Image.fromarray(r_img).save(os.path.join(output_dir, filename), format='PNG')
+    return time.time() - start
 
 
-def save_images(images, filenames, output_dir):
-    for i, filename in enumerate(filenames):
-        # Images for inception classifier are normalized to be in [-1, 1] interval,
-        # so rescale them back to [0, 1].
-        with open(os.path.join(output_dir, filename), 'w') as f:
-            img = (((images[i, :, :, :] + 1.0) * 0.5) * 255.0).astype(np.uint8)
-            # resize back to [299, 299]
-            r_img = imresize(img, [299, 299])
-            Image.fromarray(r_img).save(f, format='PNG')
+def save_images(images, filenames, output_dir, pool=None):
+    """Saves the images, returns the encode seconds or, with `pool`, the pending results."""
+    if pool is None:
+        return sum(save_image(images[i], filename, output_dir) for i, filename in enumerate(filenames))
+    return [pool.apply_async(save_image, (images[i], filename, output_dir)) for i, filename in enumerate(filenames)]
 
 
 class InceptionModel(Model):
@@ -102,30 +122,139 @@ class InceptionModel(Model):
         return self(x_input)
 
 
-def main(_):
-    """Run the sample attack"""
+class EarlyStoppingMIM(object):
+    """Targeted momentum iterative method that stops each image once it reaches its target.
+
+    Every step follows MomentumIterativeMethod of cleverhans: the gradient
+    of the negated cross entropy is normalized by its mean absolute value,
+    accumulated into the momentum and applied as `eps_iter * sign`, then
+    clipped to the `eps` ball and to [clip_min, clip_max]. The same session
+    call also predicts the current images, so an image that is already
+    classified as its target keeps its perturbation and leaves the batch,
+    and later steps only run on the images that are still active.
+    """
+    def __init__(self, model, sess, nb_classes, eps, eps_iter, nb_iter, decay_factor, clip_min, clip_max):
+        self.sess = sess
+        self.nb_iter = nb_iter
+        shape = [None, FLAGS.image_height, FLAGS.image_width, 3]
+        self.x = tf.placeholder(tf.float32, shape=shape)
+        self.adv_x = tf.placeholder(tf.float32, shape=shape)
+        self.momentum = tf.placeholder(tf.float32, shape=shape)
+        self.y_target = tf.placeholder(tf.int32, shape=[None])
+
+        logits = model.get_logits(self.adv_x)
+        self.predicted_labels = tf.argmax(logits, 1, output_type=tf.int32)
+        loss = -tf.nn.softmax_cross_entropy_with_logits(labels=tf.one_hot(self.y_target, nb_classes), logits=logits)
+        grad, = tf.gradients(loss, self.adv_x)
+        grad = grad / tf.maximum(1e-12, tf.reduce_mean(tf.abs(grad), [1, 2, 3], keepdims=True))
+        self.next_momentum = decay_factor * self.momentum + grad
+        adv_x = self.adv_x + eps_iter * tf.sign(self.next_momentum)
+        adv_x = self.x + tf.clip_by_value(adv_x - self.x, -eps, eps)
+        self.next_adv_x = tf.clip_by_value(adv_x, clip_min, clip_max)
+
+    def generate(self, images, target_labels):
+        """Returns the adversarial images and how many steps each of them took."""
+        adv_images = np.array(images, dtype=np.float32)
+        momentum = np.zeros_like(adv_images)
+        steps = np.zeros(len(images), dtype=np.int32)
+        active = np.arange(len(images))
+        for _ in range(self.nb_iter):
+            labels, next_adv_images, next_momentum = self.sess.run(
+                [self.predicted_labels, self.next_adv_x, self.next_momentum],
+                feed_dict={self.x: images[active], self.adv_x: adv_images[active],
+                           self.momentum: momentum[active], self.y_target: target_labels[active]})
+            running = labels != target_labels[active]
+            active = active[running]
+            if len(active) == 0:
+                break
+            adv_images[active] = next_adv_images[running]
+            momentum[active] = next_momentum[running]
+            steps[active] += 1
+        return adv_images, steps
+
+
+def run_shard(shard, num_shards=1):
+    """Attacks every `num_shards`-th image of dev.csv starting at `shard`, returns the stage timings."""
     batch_shape = [FLAGS.batch_size, FLAGS.image_height, FLAGS.image_width, 3]
     nb_classes = FLAGS.num_classes
     tf.logging.set_verbosity(tf.logging.INFO)
+    config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=True,
+                            intra_op_parallelism_threads=FLAGS.intra_op_threads)
+    # several workers share the GPU
+    config.gpu_options.allow_growth = num_shards > 1
+    stats = {'images': 0, 'steps': 0, 'load': 0.0, 'attack': 0.0, 'encode': 0.0}
+    start = time.time()
 
     with tf.Graph().as_default():
         # Prepare graph
-        x_input = tf.placeholder(tf.float32, shape=batch_shape)
-        target_class_input = tf.placeholder(tf.int32, shape=[FLAGS.batch_size])
+        x_input = tf.placeholder(tf.float32, shape=[None] + batch_shape[1:])
+        target_class_input = tf.placeholder(tf.int32, shape=[None])
         one_hot_target_class = tf.one_hot(target_class_input, nb_classes)
         model = InceptionModel(nb_classes)
         # Run computation
-        with tf.Session(config=tf.ConfigProto(allow_soft_placement=True, log_device_placement=True)) as sess:
-            mim = MomentumIterativeMethod(model, sess=sess)
+        with tf.Session(config=config) as sess:
             attack_params = {"eps": 32.0 / 255.0, "eps_iter": 0.01, "clip_min": -1.0, "clip_max": 1.0, \
-                             "nb_iter": 20, "decay_factor": 1.0, "y_target": one_hot_target_class}
-            x_adv = mim.generate(x_input, **attack_params)
+                             "nb_iter": 20, "decay_factor": 1.0}
+            if FLAGS.early_stop:
+                attack = EarlyStoppingMIM(model, sess, nb_classes, **attack_params)
+            else:
+                mim = MomentumIterativeMethod(model, sess=sess)
+                x_adv = mim.generate(x_input, y_target=one_hot_target_class, **attack_params)
             saver = tf.train.Saver(slim.get_model_variables())
             saver.restore(sess, FLAGS.checkpoint_path)
-            for filenames, images, tlabels in load_images(FLAGS.input_dir, batch_shape):
-                adv_images = sess.run(x_adv,
-                                      feed_dict={x_input: images, target_class_input: tlabels})
-                save_images(adv_images, filenames, FLAGS.output_dir)
+            pool = ThreadPool(FLAGS.num_encoders) if FLAGS.num_encoders > 0 else None
+            pending = []
+            batches = load_images(FLAGS.input_dir, batch_shape, shard, num_shards)
+            while True:
+                t = time.time()
+                batch = next(batches, None)
+                stats['load'] += time.time() - t
+                if batch is None:
+                    break
+                filenames, images, tlabels = batch
+                t = time.time()
+                if FLAGS.early_stop:
+                    adv_images, steps = attack.generate(images, tlabels)
+                    stats['steps'] += steps.sum()
+                else:
+                    adv_images = sess.run(x_adv,
+                                          feed_dict={x_input: images, target_class_input: tlabels})
+                    stats['steps'] += attack_params['nb_iter'] * len(filenames)
+                stats['attack'] += time.time() - t
+                if pool is None:
+                    stats['encode'] += save_images(adv_images, filenames, FLAGS.output_dir)
+                else:
+                    pending.extend(save_images(adv_images, filenames, FLAGS.output_dir, pool))
+                stats['images'] += len(filenames)
+            # encoder threads overlap the attack, their time is summed over threads
+            stats['encode'] += sum(result.get() for result in pending)
+            if pool is not None:
+                pool.close()
+                pool.join()
+    stats['wall'] = time.time() - start
+    tf.logging.info('Shard %d: %d images in %.1fs (load %.1fs, attack %.1fs, encode %.1fs), %.2f images/second, %.1f steps/image',
+                    shard, stats['images'], stats['wall'], stats['load'], stats['attack'], stats['encode'],
+                    stats['images'] / max(stats['wall'], 1e-6), stats['steps'] / max(stats['images'], 1))
+    return stats
+
+
+def main(_):
+    """Run the sample attack"""
+    if FLAGS.num_workers <= 0:
+        run_shard(0)
+        return
+    # the workers are forked before this process builds any graph
+    start = time.time()
+    pool = multiprocessing.Pool(FLAGS.num_workers)
+    stats = pool.map(functools.partial(run_shard, num_shards=FLAGS.num_workers), range(FLAGS.num_workers), chunksize=1)
+    pool.close()
+    pool.join()
+    wall = time.time() - start
+    images = sum(x['images'] for x in stats)
+    tf.logging.set_verbosity(tf.logging.INFO)
+    tf.logging.info('%d workers: %d images in %.1fs (load %.1fs, attack %.1fs, encode %.1fs summed over workers), %.2f images/second',
+                    FLAGS.num_workers, images, wall, sum(x['load'] for x in stats), sum(x['attack'] for x in stats),
+                    sum(x['encode'] for x in stats), images / max(wall, 1e-6))
 
 if __name__ == '__main__':
     tf.app.run()
\ No newline at end of file
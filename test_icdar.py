@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+pytest.importorskip('shapely')
+pytest.importorskip('tensorflow')
+import cv2
+import icdar
+from icdar import shrink_poly, fit_line, line_cross_point, point_dist_to_line, \
+    rectangle_from_parallelogram, sort_rectangle
+from shapely.geometry import Polygon
+
+if not icdar.FLAGS.is_parsed():
+    icdar.FLAGS(['test_icdar'])
+FLAGS = icdar.FLAGS
+
+
+def generate_rbox_reference(im_size, polys, tags):
+    """generate_rbox as it was before the geo_map fill was vectorized."""
+    h, w = im_size
+    poly_mask = np.zeros((h, w), dtype=np.uint8)
+    score_map = np.zeros((h, w), dtype=np.uint8)
+    geo_map = np.zeros((h, w, 5), dtype=np.float32)
+    # mask used during traning, to ignore some hard areas
+    training_mask = np.ones((h, w), dtype=np.uint8)
+    for poly_idx, poly_tag in enumerate(zip(polys, tags)):
+        poly = poly_tag[0]
+        tag = poly_tag[1]
+
+        r = [None, None, None, None]
+        for i in range(4):
+            r[i] = min(np.linalg.norm(poly[i] - poly[(i + 1) % 4]),
+                       np.linalg.norm(poly[i] - poly[(i - 1) % 4]))
+        # score map
+        shrinked_poly = shrink_poly(poly.copy(), r).astype(np.int32)[np.newaxis, :, :]
+        cv2.fillPoly(score_map, shrinked_poly, 1)
+        cv2.fillPoly(poly_mask, shrinked_poly, poly_idx + 1)
+        # if the poly is too small, then ignore it during training
+        poly_h = min(np.linalg.norm(poly[0] - poly[3]), np.linalg.norm(poly[1] - poly[2]))
+        poly_w = min(np.linalg.norm(poly[0] - poly[1]), np.linalg.norm(poly[2] - poly[3]))
+        if min(poly_h, poly_w) < FLAGS.min_text_size:
+            cv2.fillPoly(training_mask, poly.astype(np.int32)[np.newaxis, :, :], 0)
+        if tag:
+            cv2.fillPoly(training_mask, poly.astype(np.int32)[np.newaxis, :, :], 0)
+
+        xy_in_poly = np.argwhere(poly_mask == (poly_idx + 1))
+        fitted_parallelograms = []
+        for i in range(4):
+            p0 = poly[i]
+            p1 = poly[(i + 1) % 4]
+            p2 = poly[(i + 2) % 4]
+            p3 = poly[(i + 3) % 4]
+            edge = fit_line([p0[0], p1[0]], [p0[1], p1[1]])
+            backward_edge = fit_line([p0[0], p3[0]], [p0[1], p3[1]])
+            forward_edge = fit_line([p1[0], p2[0]], [p1[1], p2[1]])
+            if point_dist_to_line(p0, p1, p2) > point_dist_to_line(p0, p1, p3):
+                if edge[1] == 0:
+                    edge_opposite = [1, 0, -p2[0]]
+                else:
+                    edge_opposite = [edge[0], -1, p2[1] - edge[0] * p2[0]]
+            else:
+                if edge[1] == 0:
+                    edge_opposite = [1, 0, -p3[0]]
+                else:
+                    edge_opposite = [edge[0], -1, p3[1] - edge[0] * p3[0]]
+            # move forward edge
+            new_p0 = p0
+            new_p1 = p1
+            new_p2 = p2
+            new_p3 = p3
+            new_p2 = line_cross_point(forward_edge, edge_opposite)
+            if point_dist_to_line(p1, new_p2, p0) > point_dist_to_line(p1, new_p2, p3):
+                if forward_edge[1] == 0:
+                    forward_opposite = [1, 0, -p0[0]]
+                else:
+                    forward_opposite = [forward_edge[0], -1, p0[1] - forward_edge[0] * p0[0]]
+            else:
+                if forward_edge[1] == 0:
+                    forward_opposite = [1, 0, -p3[0]]
+                else:
+                    forward_opposite = [forward_edge[0], -1, p3[1] - forward_edge[0] * p3[0]]
+            new_p0 = line_cross_point(forward_opposite, edge)
+            new_p3 = line_cross_point(forward_opposite, edge_opposite)
+            fitted_parallelograms.append([new_p0, new_p1, new_p2, new_p3, new_p0])
+            # or move backward edge
+            new_p0 = p0
+            new_p1 = p1
+            new_p2 = p2
+            new_p3 = p3
+            new_p3 = line_cross_point(backward_edge, edge_opposite)
+            if point_dist_to_line(p0, p3, p1) > point_dist_to_line(p0, p3, p2):
+                if backward_edge[1] == 0:
+                    backward_opposite = [1, 0, -p1[0]]
+                else:
+                    backward_opposite = [backward_edge[0], -1, p1[1] - backward_edge[0] * p1[0]]
+            else:
+                if backward_edge[1] == 0:
+                    backward_opposite = [1, 0, -p2[0]]
+                else:
+                    backward_opposite = [backward_edge[0], -1, p2[1] - backward_edge[0] * p2[0]]
+            new_p1 = line_cross_point(backward_opposite, edge)
+            new_p2 = line_cross_point(backward_opposite, edge_opposite)
+            fitted_parallelograms.append([new_p0, new_p1, new_p2, new_p3, new_p0])
+        areas = [Polygon(t).area for t in fitted_parallelograms]
+        parallelogram = np.array(fitted_parallelograms[np.argmin(areas)][:-1], dtype=np.float32)
+        parallelogram_coord_sum = np.sum(parallelogram, axis=1)
+        min_coord_idx = np.argmin(parallelogram_coord_sum)
+        parallelogram = parallelogram[
+            [min_coord_idx, (min_coord_idx + 1) % 4, (min_coord_idx + 2) % 4, (min_coord_idx + 3) % 4]]
+
+        rectange = rectangle_from_parallelogram(parallelogram)
+        rectange, rotate_angle = sort_rectangle(rectange)
+
+        p0_rect, p1_rect, p2_rect, p3_rect = rectange
+        for y, x in xy_in_poly:
+            point = np.array([x, y], dtype=np.float32)
+            geo_map[y, x, 0] = point_dist_to_line(p0_rect, p1_rect, point)
+            geo_map[y, x, 1] = point_dist_to_line(p1_rect, p2_rect, point)
+            geo_map[y, x, 2] = point_dist_to_line(p2_rect, p3_rect, point)
+            geo_map[y, x, 3] = point_dist_to_line(p3_rect, p0_rect, point)
+            geo_map[y, x, 4] = rotate_angle
+    return score_map, geo_map, training_mask
+
+
+def random_polys(rng, n, size):
+    # jittered rotated rectangles, clockwise from the top left like check_and_validate_polys leaves them
+    polys = []
+    for _ in range(n):
+        cx, cy = rng.uniform(0.25 * size, 0.75 * size, 2)
+        w, h = rng.uniform(6, 0.4 * size), rng.uniform(6, 0.2 * size)
+        angle = rng.uniform(-np.pi / 4, np.pi / 4)
+        corners = np.array([[-w, -h], [w, -h], [w, h], [-w, h]]) / 2.0
+        rot = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        poly = corners.dot(rot.T) + [cx, cy] + rng.uniform(-2, 2, (4, 2))
+        polys.append(poly)
+    return np.array(polys, dtype=np.float32)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_generate_rbox_matches_reference(seed):
+    rng = np.random.RandomState(seed)
+    size = 128
+    polys = random_polys(rng, rng.randint(1, 4), size)
+    tags = rng.rand(len(polys)) < 0.2
+    expected = generate_rbox_reference((size, size), polys, tags)
+    actual = icdar.generate_rbox((size, size), polys, tags)
+    for e, a in zip(expected, actual):
+        assert e.dtype == a.dtype
+        np.testing.assert_array_equal(e.view(np.uint8), a.view(np.uint8))
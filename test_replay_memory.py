@@ -0,0 +1,94 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from replay_memory import Memory, PrioritizedMemory, TransitionSlots
+
+
+def _states(*values):
+    return np.array(values, dtype=np.float32).reshape(-1, 1, 1, 1).repeat(2, axis=-1)
+
+
+def test_fresh_refs_store_s():
+    M = Memory(10, share_states=True)
+    refs = M.store_batch(_states(1, 2), np.zeros((2, 3)), [0.5, 0.5], _states(3, 4), [-1, -1])
+    s, _, _, s_ = M._gather([0, 1])
+    np.testing.assert_array_equal(s, _states(1, 2))
+    np.testing.assert_array_equal(s_, _states(3, 4))
+    assert M.state_count == 4
+    assert M._valid(np.array([0, 1])).all()
+    np.testing.assert_array_equal(refs, [2, 3])
+
+
+def test_chained_refs_reuse_s_():
+    M = Memory(10, share_states=True)
+    refs = M.store_batch(_states(1, 2), np.zeros((2, 3)), [0, 0], _states(3, 4))
+    refs = M.store_batch(_states(3, 4), np.zeros((2, 3)), [0, 0], _states(5, 6), refs)
+    # the s of the second step is the stored s_ of the first
+    assert M.state_count == 6
+    np.testing.assert_array_equal(M.state_refs[2:4, 0], [2, 3])
+    s, _, _, s_ = M._gather([2, 3])
+    np.testing.assert_array_equal(s, _states(3, 4))
+    np.testing.assert_array_equal(s_, _states(5, 6))
+
+
+def test_overwritten_refs():
+    M = Memory(4, share_states=True)
+    refs = M.store_batch(_states(1), np.zeros((1, 3)), [0], _states(2))
+    for i in range(3):
+        M.store_batch(_states(10 + i), np.zeros((1, 3)), [0], _states(20 + i), [-1])
+    # the state ring has wrapped past the first s_, its ref is stored again
+    assert refs[0] < M.state_count - M.capacity
+    M.store_batch(_states(2), np.zeros((1, 3)), [0], _states(3), refs)
+    s, _, _, s_ = M._gather([0])
+    np.testing.assert_array_equal(s, _states(2))
+    np.testing.assert_array_equal(s_, _states(3))
+    # the transitions whose s was overwritten are never sampled
+    np.testing.assert_array_equal(M._valid(np.array([0, 1, 2, 3])), [True, False, False, True])
+    for x in M.sample(16)[0]:
+        assert x[0, 0, 0] in (2, 12)
+
+
+def _put_batch(transitions):
+    transitions.put(1, [2, 0], [True, False], _states(1, 2), np.ones((2, 3)), [0.5, 0.25], _states(3, 4))
+    transitions.close()
+
+
+def test_transition_slots_from_another_process():
+    transitions = TransitionSlots(1, 3, [1, 1, 2], [3])
+    p = multiprocessing.Process(target=_put_batch, args=(transitions,))
+    p.start()
+    slot, (actor_id, slots, fresh, s, a, r, s_) = transitions.get(timeout=10)
+    assert actor_id == 1
+    np.testing.assert_array_equal(slots, [2, 0])
+    np.testing.assert_array_equal(fresh, [True, False])
+    np.testing.assert_array_equal(s, _states(1, 2))
+    np.testing.assert_array_equal(a, np.ones((2, 3)))
+    np.testing.assert_array_equal(r, [0.5, 0.25])
+    np.testing.assert_array_equal(s_, _states(3, 4))
+    transitions.release(slot)
+    assert transitions.get(timeout=10) is None
+    p.join()
+
+
+def test_new_transitions_get_max_priority():
+    M = PrioritizedMemory(4)
+    M.store_batch(_states(1, 2), np.zeros((2, 3)), [0, 0], _states(3, 4))
+    np.testing.assert_allclose(M.tree.tree[-4:-2], M.abs_err_upper)
+    M.update_priorities([0, 1], [0.2, 0.1])
+    M.store_batch(_states(5), np.zeros((1, 3)), [0], _states(6))
+    np.testing.assert_allclose(M.tree.tree[-2], np.power(0.2 + M.epsilon, M.alpha))
+
+
+def test_reopen_checks_shapes(tmpdir):
+    M = Memory(4, 'float16', str(tmpdir))
+    M.store_batch(_states(1, 2), np.zeros((2, 3)), [0, 0], _states(3, 4))
+    M.flush()
+    M = Memory(4, 'float16', str(tmpdir))
+    assert len(M) == 2
+    assert M.state_shape == (1, 1, 2) and M.action_shape == (3,)
+    with pytest.raises(ValueError):
+        M.store_batch(_states(5), np.zeros((1, 4)), [0], _states(6))
+    with pytest.raises(ValueError):
+        Memory(4, 'int8', str(tmpdir))
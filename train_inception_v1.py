@@ -14,7 +14,8 @@ import time
 import tensorflow as tf
 from tensorflow.contrib.slim.nets import inception
 slim = tf.contrib.slim
-from mytools import load_path_label
+from mytools import load_path_label, DecodePool
+from async_saver import AsyncSaver
 
 tf.flags.DEFINE_string(
     'checkpoint_path', './defense_example/models/inception_v1/', 'Path to checkpoint for inception network.')
@@ -40,6 +41,22 @@ tf.flags.DEFINE_integer(
     'max_steps', 3437, 'The number of steps')
 tf.flags.DEFINE_string(
     'pretrained_model_path', None, '')
+tf.flags.DEFINE_string(
+    'image_store_dir', '', 'Directory of the pre-decoded uint8 image store, empty to decode images on the fly.')
+tf.flags.DEFINE_integer(
+    'num_loader_workers', 0, 'Processes used to decode images, 0 to decode in the main process')
+tf.flags.DEFINE_integer(
+    'loader_prefetch', 2, 'How many batches the loader workers decode ahead')
+tf.flags.DEFINE_integer(
+    'summary_steps', 50, 'Steps between evaluated summaries')
+tf.flags.DEFINE_integer(
+    'log_steps', 10, 'Steps between printed losses and throughput')
+tf.flags.DEFINE_boolean(
+    'use_tf_data', False, 'Read images with a tf.data pipeline instead of feeding them from load_path_label')
+tf.flags.DEFINE_integer(
+    'num_parallel_calls', 8, 'Images the tf.data pipeline decodes in parallel')
+tf.flags.DEFINE_integer(
+    'shuffle_buffer', 10000, 'Shuffle buffer size of the tf.data pipeline')
 
 FLAGS = tf.flags.FLAGS
 
@@ -65,6 +82,28 @@ def load_images(input_dir, batch_shape):
         yield filenames, images
 
 
+def build_dataset(fname, batch_size, separator='\t'):
+    with open(fname, 'r') as f:
+        rows = [x.strip().split(separator) for x in f if x.strip()]
+    filepaths = [r[0] for r in rows]
+    labels = [int(r[1]) for r in rows]
+
+    def _decode(filepath, label):
+        image = tf.image.decode_image(tf.read_file(filepath), channels=3)
+        image.set_shape([None, None, 3])
+        image = tf.image.resize_images(image, [FLAGS.image_height, FLAGS.image_width])
+        image = (image / 255.0) * 2.0 - 1.0
+        return image, tf.one_hot(label, FLAGS.num_classes)
+
+    dataset = tf.data.Dataset.from_tensor_slices((filepaths, labels))
+    dataset = dataset.shuffle(FLAGS.shuffle_buffer).repeat()
+    dataset = dataset.map(_decode, num_parallel_calls=FLAGS.num_parallel_calls)
+    # skip images that fail to decode, like load_path_label does
+    dataset = dataset.apply(tf.contrib.data.ignore_errors())
+    dataset = dataset.batch(batch_size).prefetch(FLAGS.loader_prefetch)
+    return dataset
+
+
 def main(_):
     if not tf.gfile.Exists(FLAGS.checkpoint_path):
         tf.gfile.MkDir(FLAGS.checkpoint_path)
@@ -75,8 +114,18 @@ def main(_):
 
     batch_shape = [FLAGS.batch_size, FLAGS.image_height, FLAGS.image_width, 3]
     nb_classes = FLAGS.num_classes
-    input_images = tf.placeholder(tf.float32, [None, FLAGS.image_height, FLAGS.image_width, 3])
-    input_labels = tf.placeholder(tf.float32, [None, nb_classes])
+    # the decode workers are forked before the graph and session exist
+    decode_pool = None
+    if FLAGS.num_loader_workers > 0 and not FLAGS.use_tf_data and not FLAGS.image_store_dir:
+        decode_pool = DecodePool(batch_shape, FLAGS.num_loader_workers, FLAGS.loader_prefetch)
+    if FLAGS.use_tf_data:
+        # the batches come from the pipeline, feeding the placeholders still overrides them
+        next_images, next_labels = build_dataset('./datasets/train_labels.txt', FLAGS.batch_size).make_one_shot_iterator().get_next()
+        input_images = tf.placeholder_with_default(next_images, [None, FLAGS.image_height, FLAGS.image_width, 3])
+        input_labels = tf.placeholder_with_default(next_labels, [None, nb_classes])
+    else:
+        input_images = tf.placeholder(tf.float32, [None, FLAGS.image_height, FLAGS.image_width, 3])
+        input_labels = tf.placeholder(tf.float32, [None, nb_classes])
 
     learning_rate = FLAGS.learning_rate
     # add summary
@@ -94,7 +143,18 @@ def main(_):
 
     summary_op = tf.summary.merge_all()
 
+    # the loss is summed in the graph and only read back on logging steps
+    with tf.variable_scope('loss_accumulator'):
+        loss_sum = tf.get_variable('loss_sum', [], initializer=tf.zeros_initializer(), trainable=False)
+        loss_count = tf.get_variable('loss_count', [], initializer=tf.zeros_initializer(), trainable=False)
+        step_op = tf.group(train_op, tf.assign_add(loss_sum, total_loss_op), tf.assign_add(loss_count, 1.0))
+        mean_loss_op = loss_sum / tf.maximum(loss_count, 1.0)
+        with tf.control_dependencies([mean_loss_op]):
+            reset_loss_op = tf.group(tf.assign(loss_sum, 0.0), tf.assign(loss_count, 0.0))
+
     saver = tf.train.Saver(variables_to_restore)
+    # epoch checkpoints are written on a background thread
+    async_saver = AsyncSaver(variables_to_restore)
     summary_writer = tf.summary.FileWriter(FLAGS.checkpoint_path, tf.get_default_graph())
 
     init = tf.global_variables_initializer()
@@ -115,25 +175,38 @@ def main(_):
 
         for epoch in range(FLAGS.max_epochs):
             start = time.time()
-            data_generator = load_path_label('./datasets/train_labels.txt', batch_shape, onehot=True)
+            if not FLAGS.use_tf_data:
+                data_generator = load_path_label('./datasets/train_labels.txt', batch_shape, onehot=True, store_dir=FLAGS.image_store_dir,
+                                                 seed=epoch, pool=decode_pool)
             for step in range(FLAGS.max_steps):
-                data = next(data_generator)
-                _, total_loss, res = sess.run([train_op, total_loss_op, summary_op], feed_dict={input_images: data[0], input_labels:data[1]})
-                if step % 50 == 0:
+                feed_dict = None
+                if not FLAGS.use_tf_data:
+                    data = next(data_generator)
+                    feed_dict = {input_images: data[0], input_labels:data[1]}
+                if step % FLAGS.summary_steps == 0:
+                    _, res = sess.run([step_op, summary_op], feed_dict=feed_dict)
                     summary_writer.add_summary(res, step)
-                
-                if np.isnan(total_loss):
-                    print('Loss diverged, stop training')
-                    break
-
-                if step % 10 == 0:
-                    avg_time_per_step = (time.time() - start)/10
-                    avg_examples_per_second = (10 * FLAGS.batch_size) /(time.time() - start)
+                else:
+                    sess.run(step_op, feed_dict=feed_dict)
+
+                if step % FLAGS.log_steps == 0:
+                    total_loss, _ = sess.run([mean_loss_op, reset_loss_op])
+                    if np.isnan(total_loss):
+                        print('Loss diverged, stop training')
+                        break
+
+                    avg_time_per_step = (time.time() - start)/FLAGS.log_steps
+                    avg_examples_per_second = (FLAGS.log_steps * FLAGS.batch_size) /(time.time() - start)
                     start = time.time()
                     print('Step {:06d}, total loss {:.4f}, {:.2f} seconds/step, {:.2f} examples/second'.format(
                         step, total_loss, avg_time_per_step, avg_examples_per_second))
             
-            saver.save(sess, FLAGS.checkpoint_path+'robust_model', global_step=epoch)
+            async_saver.save(sess, FLAGS.checkpoint_path+'robust_model', global_step=epoch)
+            if async_saver.latencies:
+                print('Checkpoint snapshot: {:.3f} seconds, write: {:.3f} seconds'.format(*async_saver.latencies[-1]))
+        async_saver.close()
+    if decode_pool is not None:
+        decode_pool.close()
 
 if __name__ == '__main__':
     tf.app.run()